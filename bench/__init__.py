@@ -0,0 +1,5 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-03 21:00
+本地基准测试：模拟妹子图网站结构的假站点，以及驱动 Spider 完整采集流程的测试脚本
+"""
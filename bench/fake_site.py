@@ -0,0 +1,197 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-03 21:10
+模拟妹子图网站的本地服务：专题页、标签页（分页）、标签分页列表、合集首页和图片，可配置延迟、错误率和限流率
+"""
+import asyncio
+import random
+import threading
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+
+@dataclass
+class SiteConfig:
+    tags: int = 5  # 标签数
+    pages_per_tag: int = 4  # 每个标签的分页数
+    pins_per_page: int = 24  # 每个分页的合集数
+    collections: int = 200  # 合集总数（标签之间会有重复的合集）
+    images_per_collection: int = 20
+    image_size: int = 200 * 1024  # 图片字节数
+    latency: float = 0.02  # 每个请求的延迟（秒）
+    error_rate: float = 0.0  # 返回 500 的概率
+    throttle_rate: float = 0.0  # 返回 429 的概率
+    retry_after: int = 1  # 429 响应的 Retry-After（秒）
+    seed: int = 0
+
+
+@dataclass
+class SiteStats:
+    pages: int = 0
+    images: int = 0
+    bytes: int = 0
+    errors: int = 0
+    throttled: int = 0
+    by_path: dict = field(default_factory=dict)
+
+
+class FakeSite:
+    """模拟网站
+
+    页面结构与 `mzitu.core.coroutines` 中的 XPath 对应：
+    /zhuanti/ 的 `dl.tags`，/tag/{tag}/ 的 `nav-links`，/{tag}/page/{n} 的 `#pins`，/{num} 的 `pagenavi`/`main-image` 等。
+    """
+
+    def __init__(self, config: SiteConfig = None):
+        self.config = config or SiteConfig()
+        self.stats = SiteStats()
+        self.base_url = None
+        self._random = random.Random(self.config.seed)
+        self._image = self._make_image()
+        self._runner = None
+        self._loop = None
+        self._thread = None
+
+    def _make_image(self):
+        """生成带有 JPEG 起止标记的图片数据"""
+        size = max(self.config.image_size, 4)
+        body = bytes(self._random.getrandbits(8) for _ in range(min(size - 4, 4096)))
+        body = (body * ((size - 4) // max(len(body), 1) + 1))[:size - 4]
+        return b"\xff\xd8" + body + b"\xff\xd9"
+
+    def tag_names(self):
+        return [f"tag{i}" for i in range(self.config.tags)]
+
+    def numbers_in_page(self, tag_index, page):
+        """标签分页中的合集编号，编号越大越新，第一页最新"""
+        config = self.config
+        start = (tag_index * config.pages_per_tag * config.pins_per_page // 2 + (page - 1) * config.pins_per_page)
+        return [100000 + config.collections - 1 - (start + i) % config.collections for i in range(config.pins_per_page)]
+
+    @staticmethod
+    def image_dir(number):
+        """图片目录（对应年/月），解析时按路径第 4、5 段取年、月"""
+        return f"{number // 100:04d}/{number % 100:02d}"
+
+    async def _handle(self, request, kind, render):
+        config = self.config
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        if config.throttle_rate and self._random.random() < config.throttle_rate:
+            self.stats.throttled += 1
+            return web.Response(status=429, headers={"Retry-After": str(config.retry_after)})
+        if config.error_rate and self._random.random() < config.error_rate:
+            self.stats.errors += 1
+            return web.Response(status=500)
+
+        response = render()
+        if kind == "image":
+            self.stats.images += 1
+        else:
+            self.stats.pages += 1
+        self.stats.by_path[kind] = self.stats.by_path.get(kind, 0) + 1
+        self.stats.bytes += response.content_length or 0
+        return response
+
+    def _html(self, body):
+        return web.Response(text=f"<html><body>{body}</body></html>", content_type="text/html")
+
+    async def zhuanti(self, request):
+        def render():
+            links = "".join(f'<dd><a href="https://www.mzitu.com/tag/{tag}/">{tag}</a></dd>' for tag in self.tag_names())
+            return self._html(f'<dl class="tags">{links}</dl>')
+        return await self._handle(request, "zhuanti", render)
+
+    async def tag(self, request):
+        def render():
+            pages = "".join(f"<a>{i}</a>" for i in range(1, self.config.pages_per_tag + 1))
+            return self._html(f'<div class="nav-links">{pages}<a>下一页</a></div>')
+        return await self._handle(request, "tag", render)
+
+    async def tag_page(self, request):
+        tag = request.match_info["tag"]
+        page = int(request.match_info["page"])
+
+        def render():
+            if tag not in self.tag_names() or not 1 <= page <= self.config.pages_per_tag:
+                raise web.HTTPNotFound()
+            numbers = self.numbers_in_page(self.tag_names().index(tag), page)
+            pins = "".join(f'<li><a href="{self.base_url}/{number}">{number}</a></li>' for number in numbers)
+            return self._html(f'<ul id="pins">{pins}</ul>')
+        return await self._handle(request, "listing", render)
+
+    async def collection(self, request):
+        number = int(request.match_info["number"])
+
+        def render():
+            count = self.config.images_per_collection
+            tags = "".join(f"<a>{tag}</a>" for tag in self._random.sample(self.tag_names(), min(2, self.config.tags)))
+            pages = "".join(f"<a><span>{i}</span></a>" for i in range(1, count + 1))
+            src = f"{self.base_url}/{self.image_dir(number)}/01a01.jpg"
+            return self._html(
+                f'<h2 class="main-title">合集{number}</h2>'
+                f'<div class="main-tags">{tags}</div>'
+                f'<div class="main-image"><p><a><img src="{src}"></a></p></div>'
+                f'<div class="pagenavi">{pages}<a><span>下一页</span></a></div>'
+            )
+        return await self._handle(request, "collection", render)
+
+    async def image(self, request):
+        def render():
+            return web.Response(body=self._image, content_type="image/jpeg")
+        return await self._handle(request, "image", render)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/zhuanti/", self.zhuanti)
+        app.router.add_get("/tag/{tag}/", self.tag)
+        app.router.add_get("/{tag}/page/{page:\\d+}", self.tag_page)
+        app.router.add_get("/{number:\\d+}", self.collection)
+        app.router.add_get("/{year:\\d+}/{month:\\d+}/{file}", self.image)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def start_in_thread(self, host="127.0.0.1", port=0):
+        """在后台线程的事件循环中启动服务，返回站点地址"""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start(host, port))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="fake-site", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.base_url
+
+    def stop_thread(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    fake_site = FakeSite()
+    print(fake_site.start_in_thread(port=8765))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake_site.stop_thread()
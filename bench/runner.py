@@ -0,0 +1,147 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-03 22:00
+端到端采集基准测试
+
+启动本地假站点，在子进程中以覆盖后的 SITE_BASE_URL、DL_PATH、DB_ENGINE 运行 Spider，
+统计页面/秒、图片/秒、MB/秒、子进程内存峰值和数据库大小，结果追加到 bench/results.jsonl，并与上一次相同配置的结果比较。
+
+用法：python -m bench.runner [--collections 200] [--latency 0.02] [--set DL_CONCURRENCY=5] ...
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, fields
+
+from bench.fake_site import FakeSite, SiteConfig
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(ROOT_PATH, "bench", "results.jsonl")
+
+# 基准测试默认的设置覆盖：放开限速，缩短重试等待，只测量采集流程本身
+DEFAULT_OVERRIDES = {
+    "DEBUG": "False",
+    "RATE_INITIAL": "200",
+    "RATE_MAX": "1000",
+    "RATE_BURST": "50",
+    "IMG_RETRY_BACKOFF": "0.1",
+    "PAGE_CACHE_ENABLED": "False",
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_spider(work_dir, overrides):
+    """在子进程中运行 Spider，返回耗时（秒）和退出码"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT_PATH + os.pathsep + env.get("PYTHONPATH", "")
+    env.update({f"MZITU_{name}": value for name, value in overrides.items()})
+
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", "from mzitu import Spider; Spider().start()"], cwd=work_dir,
+                             env=env)
+    return time.perf_counter() - start, process.returncode
+
+
+def previous_result(config, overrides):
+    """返回相同配置的上一次结果"""
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    last = None
+    with open(RESULTS_FILE, encoding="utf-8") as fd:
+        for line in fd:
+            result = json.loads(line)
+            if result["config"] == config and result["overrides"] == overrides:
+                last = result
+    return last
+
+
+def benchmark(config: SiteConfig, overrides: dict):
+    fake_site = FakeSite(config)
+    base_url = fake_site.start_in_thread()
+    try:
+        with tempfile.TemporaryDirectory(prefix="mzitu-bench-") as work_dir:
+            dl_path = os.path.join(work_dir, "download")
+            db_file = os.path.join(work_dir, "bench.db")
+            overrides = dict(DEFAULT_OVERRIDES, **overrides)
+            overrides.update({
+                "SITE_BASE_URL": base_url,
+                "DL_PATH": dl_path,
+                "DB_ENGINE": f"sqlite:///{db_file}",
+                # 假站点的标签列表不能写入正式的标签缓存
+                "TAG_CACHE_FILE": os.path.join(work_dir, "tags.json"),
+            })
+
+            elapsed, returncode = run_spider(work_dir, overrides)
+            db_size = sum(os.path.getsize(db_file + suffix) for suffix in ("", "-wal")
+                          if os.path.exists(db_file + suffix))
+    finally:
+        fake_site.stop_thread()
+
+    stats = fake_site.stats
+    # Linux 下 ru_maxrss 单位为 KB，macOS 下为字节
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak_rss_mb = peak_rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": git_revision(),
+        "config": asdict(config),
+        "overrides": {name: value for name, value in overrides.items()
+                      if name not in ("SITE_BASE_URL", "DL_PATH", "DB_ENGINE", "TAG_CACHE_FILE")},
+        "returncode": returncode,
+        "elapsed": round(elapsed, 3),
+        "pages": stats.pages,
+        "images": stats.images,
+        "pages_per_sec": round(stats.pages / elapsed, 2),
+        "images_per_sec": round(stats.images / elapsed, 2),
+        "mb_per_sec": round(stats.bytes / elapsed / 1024 / 1024, 2),
+        "errors": stats.errors,
+        "throttled": stats.throttled,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "db_size_mb": round(db_size / 1024 / 1024, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="mzitu 端到端采集基准测试")
+    for config_field in fields(SiteConfig):
+        parser.add_argument(f"--{config_field.name.replace('_', '-')}", type=type(config_field.default),
+                            default=config_field.default)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="覆盖 mzitu.settings 中的设置")
+    parser.add_argument("--no-save", action="store_true", help="不保存结果")
+    args = parser.parse_args(argv)
+
+    config = SiteConfig(**{config_field.name: getattr(args, config_field.name) for config_field in fields(SiteConfig)})
+    overrides = dict(item.split("=", 1) for item in args.set)
+
+    result = benchmark(config, overrides)
+    last = previous_result(result["config"], result["overrides"])
+
+    for key in ("elapsed", "pages_per_sec", "images_per_sec", "mb_per_sec", "peak_rss_mb", "db_size_mb"):
+        line = f"{key:>16}: {result[key]}"
+        if last and last.get(key):
+            line += f"  ({(result[key] - last[key]) / last[key] * 100:+.1f}% 对比 {last['revision']} {last['time']})"
+        print(line)
+    if result["returncode"]:
+        print(f"Spider 异常退出：{result['returncode']}")
+
+    if not args.no_save:
+        with open(RESULTS_FILE, "a", encoding="utf-8") as fd:
+            fd.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ import os
 import platform
 import sched
 import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 MAX_ALIVE_DAYS = 30
 SAFE_DAYS = 10
@@ -19,17 +20,20 @@ class Sweeper:
     clear the expired files under the specified path.
     """
 
-    def __init__(self, base_path, safe_age=None, max_age=None, file_func=None, folder_func=None, by_modify=True):
+    def __init__(self, base_path, safe_age=None, max_age=None, file_func=None, folder_func=None, by_modify=True,
+                 workers=None):
         """
         :param base_path: root directory
         :param safe_age: minimum seconds for a file to survive
         :param max_age: if seconds of existence exceed this value, file will be handled
-        :param file_func: when file is expired, this func will be called
+        :param file_func: when file is expired, this func will be called, possibly from several threads at once
         :param folder_func: the func to deal with empty folder
         :param by_modify:  which is time of last modification or last access
+        :param workers: number of threads scanning directories concurrently, default as ThreadPoolExecutor
         """
         self.base_path = base_path
         self.by_modify = by_modify
+        self.workers = workers
 
         self.safe_age = safe_age or 3600 * 24 * SAFE_DAYS
         self.max_age = max_age or 3600 * 24 * MAX_ALIVE_DAYS
@@ -38,19 +42,71 @@ class Sweeper:
         self.folder_func = folder_func or self.remove
 
     def scan(self):
-        for root, dirnames, filenames in os.walk(self.base_path, topdown=False):
-            for filename in filenames:
-                filepath = os.path.join(root, filename)
-
-                file_stat = os.stat(filepath)
-                basis_time = file_stat.st_mtime if self.by_modify else file_stat.st_atime
-                if time.time() - basis_time > self.max_age:
-                    self.file_func(filepath)
-
-            for dirname in dirnames:
-                dirpath = os.path.join(root, dirname)
-                if not os.listdir(dirpath):
-                    self.folder_func(dirpath)
+        """Handle expired files, then empty folders from the deepest up.
+
+        Directories are scanned concurrently with `os.scandir`, each one a separate task, so
+        subtrees are walked in parallel. File times come from the `DirEntry` stat data and are
+        compared against a single reference time; whether a folder is empty is decided from the
+        scan results instead of listing it again.
+        """
+        now = time.time()
+        # directory -> (depth, subdirectories, number of entries left in it)
+        tree = {}
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = {executor.submit(self._scan_dir, self.base_path, now, 0)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, depth, subdirs, remaining = future.result()
+                    tree[path] = (depth, subdirs, remaining)
+                    pending.update(executor.submit(self._scan_dir, subdir, now, depth + 1) for subdir in subdirs)
+
+        removed = set()
+        for path in sorted(tree, key=lambda p: tree[p][0], reverse=True):
+            depth, subdirs, remaining = tree[path]
+            if not depth or remaining or not all(subdir in removed for subdir in subdirs):
+                continue
+            self.folder_func(path)
+            if self._gone(path, self.folder_func):
+                removed.add(path)
+
+    def _scan_dir(self, path, now, depth):
+        """Handle the expired files directly under `path`.
+
+        :return: (path, depth, subdirectories, number of entries that are neither subdirectories nor handled)
+        """
+        subdirs = []
+        remaining = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                            continue
+                        if entry.is_dir():
+                            # symbolic link to a directory, not followed
+                            remaining += 1
+                            continue
+                        file_stat = entry.stat()
+                    except OSError:
+                        remaining += 1
+                        continue
+
+                    basis_time = file_stat.st_mtime if self.by_modify else file_stat.st_atime
+                    if now - basis_time > self.max_age:
+                        self.file_func(entry.path)
+                        if self._gone(entry.path, self.file_func):
+                            continue
+                    remaining += 1
+        except OSError:
+            # unreadable directory, keep it
+            remaining += 1
+        return path, depth, subdirs, remaining
+
+    def _gone(self, path, func):
+        """whether `func` has removed `path`, only checked for user supplied functions"""
+        return func == self.remove or not os.path.lexists(path)
 
     def remove(self, path):
         if os.path.isdir(path):
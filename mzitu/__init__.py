@@ -6,23 +6,29 @@ time: 2020-09-27 22:40
 """
 import sys
 import warnings
-
-from mzitu.spider import Spider
+from importlib.util import find_spec
 
 python_version = sys.version_info
 if python_version.major < 3 and python_version.minor < 8:
     raise RuntimeError("不支持Python3.8 以下的版本")
 
-try:
-    import lxml, aiohttp, sqlalchemy
-except ImportError:
+if not all(find_spec(name) for name in ("lxml", "aiohttp", "sqlalchemy")):
     raise RuntimeError("请先安装依赖：lxml、aiohttp、sqlalchemy")
 
 warnings.warn("仅供学习使用，请勿用于商业行为或影响到网站正常运行！！！")
 
 
+def __getattr__(name):
+    # 按需导入爬虫，只使用数据库统计等功能时无需加载 aiohttp、lxml
+    if name == "Spider":
+        from mzitu.spider import Spider
+        return Spider
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def start():
     """`妹子图`"""
+    from mzitu.spider import Spider
     Spider().start()
 
 
@@ -0,0 +1,124 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-05 22:10
+命令行入口：python -m mzitu <命令> [选项]
+
+    crawl   采集并下载，--mode 指定运行模式（single / worker / coordinator）
+    report  输出数据库统计
+    reset   重置下载记录
+    verify  校验已下载的图片，缺失或损坏的图片重新标记为待下载，--dry-run 只检查不修改
+    pack    将已下载完成的合集目录打包为单个文件（开启 PACK_ENABLED 后新下载的合集会自动打包）
+
+所有命令都可以用 `-s 名称=值` 覆盖 `mzitu.settings` 中的设置（可重复），值按 Python 字面量解析，
+例如：python -m mzitu -s DL_PATH=/data/mm -s DL_CONCURRENCY=5 crawl
+各命令只导入自身需要的模块，`report`、`reset` 不会加载 aiohttp、lxml。
+"""
+import argparse
+import os
+import sys
+
+
+def apply_overrides(parser, pairs):
+    """将 `名称=值` 形式的设置覆盖写入环境变量，由 `mzitu.settings` 在导入时读取"""
+    for pair in pairs:
+        name, sep, value = pair.partition("=")
+        name = name.strip()
+        if not sep or not name.isupper():
+            parser.error(f"设置格式错误：{pair}，应为 名称=值")
+        os.environ["MZITU_" + name] = value
+
+    from mzitu import settings
+    for pair in pairs:
+        name = pair.partition("=")[0].strip()
+        if not hasattr(settings, name):
+            parser.error(f"未知的设置：{name}")
+
+
+def crawl(args):
+    from mzitu.spider import Spider
+    Spider().start(args.mode)
+
+
+def report(args):
+    from mzitu.core.base import DB
+    db = DB()
+    try:
+        total_nums, info_nums, dl_nums, picture_nums = db.report()
+    finally:
+        db.close()
+    print(f"共有合集：{total_nums} 个，包含图片：{picture_nums} 张，"
+          f"已完成合集元数据获取：{info_nums} 个，已完成图片下载：{dl_nums}个")
+
+
+def reset(args):
+    from mzitu.core.base import DB
+    db = DB()
+    try:
+        count = db.reset_dl().result()
+    finally:
+        db.close()
+    print(f"已重置下载记录：{count} 个合集")
+
+
+def verify(args):
+    from mzitu.core.base import DB
+    from mzitu.core.verify import verify as verify_pictures
+    db = DB()
+    try:
+        stats = verify_pictures(db, workers=args.workers, repair=not args.dry_run)
+    finally:
+        db.close()
+    print(f"校验合集：{stats['collections']} 个，图片：{stats['pictures']} 张，有问题的图片：{stats['problems']} 张"
+          + ("" if args.dry_run or not stats["problems"] else "，已标记为待下载，下次采集时重新下载"))
+
+
+def pack(args):
+    from mzitu.core.base import DB
+    from mzitu.core.storage import collection_dir, pack_collection
+    db = DB()
+    collections = pictures = 0
+    try:
+        for pending, dl_status in db.iter_info_collection():
+            dir_path = collection_dir(pending.name)
+            if dl_status == 1 and os.path.isdir(dir_path):
+                pictures += pack_collection(dir_path)
+                collections += 1
+    finally:
+        db.close()
+    print(f"已打包合集：{collections} 个，图片：{pictures} 张")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m mzitu", description="妹子图美女图片下载")
+    parser.add_argument("-s", "--set", dest="overrides", action="append", default=[], metavar="名称=值",
+                        help="覆盖设置，可重复使用")
+    commands = parser.add_subparsers(dest="command", metavar="命令")
+    commands.required = True
+
+    crawl_parser = commands.add_parser("crawl", help="采集并下载")
+    crawl_parser.add_argument("--mode", choices=("single", "worker", "coordinator"), default="single",
+                              help="运行模式，默认：single")
+    crawl_parser.set_defaults(func=crawl)
+
+    commands.add_parser("report", help="输出数据库统计").set_defaults(func=report)
+    commands.add_parser("reset", help="重置下载记录").set_defaults(func=reset)
+
+    verify_parser = commands.add_parser("verify", help="校验已下载的图片")
+    verify_parser.add_argument("--workers", type=int, default=None, help="进程数，默认：VERIFY_WORKERS 或 CPU 核数")
+    verify_parser.add_argument("--dry-run", action="store_true", help="只检查，不修改下载记录")
+    verify_parser.set_defaults(func=verify)
+
+    commands.add_parser("pack", help="打包已下载完成的合集").set_defaults(func=pack)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    apply_overrides(parser, args.overrides)
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
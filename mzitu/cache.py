@@ -0,0 +1,92 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-10-22 20:40
+网页缓存：压缩存储在磁盘上，支持条件请求（ETag/Last-Modified）和离线重放
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+
+
+class PageCache:
+    """按 URL 缓存网页
+
+    `ttls` 为 (正则, 秒数) 列表，按顺序匹配 URL：缓存未过期时直接返回，过期后发送条件请求；
+    未匹配的 URL 不缓存。离线模式下只从缓存读取，不访问网络。
+    """
+
+    def __init__(self, cache_path, ttls, offline=False):
+        self.cache_path = cache_path
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.offline = offline
+
+    def ttl(self, url):
+        """返回该 URL 的缓存时间，不缓存时返回 None"""
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return None
+
+    def _path(self, url):
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_path, digest[:2], digest + ".json.gz")
+
+    def is_fresh(self, url, entry):
+        ttl = self.ttl(url)
+        return ttl is not None and time.time() - entry["time"] < ttl
+
+    @staticmethod
+    def validators(entry) -> dict:
+        """根据缓存构造条件请求头"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _read(self, url):
+        try:
+            with gzip.open(self._path(url), "rt", encoding="utf-8") as fd:
+                return json.load(fd)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+
+    def _write(self, url, entry):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as fd:
+            json.dump(entry, fd, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    async def load(self, url):
+        """读取缓存，未命中或该 URL 不缓存时返回 None"""
+        if not self.offline and self.ttl(url) is None:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._read, url)
+
+    async def store(self, url, body, headers):
+        """写入缓存"""
+        if self.ttl(url) is None:
+            return
+        entry = {
+            "url": url,
+            "time": time.time(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "body": body,
+        }
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write, url, entry)
+
+    async def touch(self, url, entry):
+        """服务器返回 304 时刷新缓存时间"""
+        entry["time"] = time.time()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write, url, entry)
@@ -2,25 +2,85 @@
 """
 time: 2020-09-27 22:59 
 """
-from sqlalchemy import create_engine, func
+import asyncio
+import atexit
+import datetime
+import time
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from sqlalchemy import create_engine, event, func, inspect, text, and_, or_, case, select, bindparam
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
 
-from mzitu.core.model import base, DownloadRecord, Collection, Tag
-from mzitu.utils import get_logger
+from mzitu.core.model import base, DownloadRecord, Collection, Tag, collection_tag, PictureRecord, TagCrawl, \
+    PICTURE_PENDING
+from mzitu.core.writer import DBWriter
+from mzitu.settings import DB_ENGINE, DB_DURABLE, SQLITE_PRAGMAS, PENDING_PAGE_SIZE, LEASE_TTL, INFO_MAX_ATTEMPTS, \
+    INFO_RETRY_BACKOFF
+from mzitu.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def published_date(year, month, day):
+    """由合集的 year、month、day 字段得到发布日期，无法解析时返回 None"""
+    try:
+        return datetime.date(int(year), int(month), int(day))
+    except (TypeError, ValueError):
+        return None
+
+
+
+def _info_not_exhausted():
+    return or_(DownloadRecord.attempts.is_(None), DownloadRecord.attempts < INFO_MAX_ATTEMPTS)
+
+
+def _pending():
+    """待处理的合集：未获取元数据（失败次数未耗尽），或已获取元数据但未下载"""
+    return or_(and_(DownloadRecord.status == 0, _info_not_exhausted()),
+               and_(DownloadRecord.status == 1, DownloadRecord.dl_status == 0))
+
 
-logger = get_logger()
+def _lease_free(now):
+    """没有租约、租约已过期，且不在失败退避期内"""
+    return or_(DownloadRecord.lease_expires.is_(None), DownloadRecord.lease_expires < now)
+
+class PendingCollection(NamedTuple):
+    """待下载的合集，图片地址在下载时按需生成"""
+    num: str
+    name: str
+    prefix: str
+    suffix: str
+    count: int
+
+    def picture_urls(self):
+        for i in range(1, self.count + 1):
+            num = "0" + str(i) if i < 10 else str(i)
+            yield self.prefix + num + self.suffix
 
 
 class DB:
-    def __init__(self, db_engine=None):
-        self.db_engine = db_engine or "sqlite:///mm.db"
+    """数据库操作
+
+    读操作在调用线程中直接执行；写操作交给后台的 `DBWriter` 按批提交，返回 Future。
+    """
+
+    def __init__(self, db_engine=None, durable=None):
+        self.db_engine = db_engine or DB_ENGINE
+        self.durable = DB_DURABLE if durable is None else durable
         logger.debug(f"db_engine：{self.db_engine}")
         try:
-            engine = create_engine(self.db_engine, echo=False)
-            db_session = sessionmaker(bind=engine)
-            self.session = db_session()
+            connect_args = {"check_same_thread": False} if self.db_engine.startswith("sqlite") else {}
+            engine = create_engine(self.db_engine, echo=False, connect_args=connect_args)
+            if engine.dialect.name == "sqlite":
+                event.listen(engine, "connect", self._apply_sqlite_pragmas)
+            self.session_factory = sessionmaker(bind=engine)
+            self.session = self.session_factory()
             # 创建表（如果表已经存在，则不会创建）
             base.metadata.create_all(engine)
+            self._migrate(engine)
+            self.fts = engine.dialect.name == "sqlite" and self._create_fts(engine)
             logger.info("数据库已连接")
         except ImportError as e:
             if e.name == '_sqlite3':
@@ -29,103 +89,290 @@ class DB:
                 logger.error(f"请检查是否安装此模块：{e.name}")
             exit()
 
+        # 标签名 -> 标签ID 的缓存，启动时加载一次，此后只在写库线程中读写
+        self.tag_cache = {}
+        self._load_tags(self.session)
+        self.session.rollback()
+
+        self.writer = DBWriter(self.session_factory, on_rollback=self._load_tags)
+        self.writer.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+        """为 SQLite 连接应用性能参数"""
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    @staticmethod
+    def _migrate(engine):
+        """为旧版本数据库补充字段、约束和索引"""
+        tag_indexes = {index["name"] for index in inspect(engine).get_indexes(Tag.__tablename__)}
+        if "ix_tag_tag_name" not in tag_indexes:
+            # 合并重名标签，之后才能建立唯一索引
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "UPDATE collection_tag SET tag_id = ("
+                    "SELECT MIN(t2.tag_id) FROM tag t1 JOIN tag t2 ON t1.tag_name = t2.tag_name "
+                    "WHERE t1.tag_id = collection_tag.tag_id)"
+                ))
+                # 合并后同一合集可能关联同一标签多次，每对只保留一行
+                conn.execute(text(
+                    "DELETE FROM collection_tag WHERE rowid NOT IN "
+                    "(SELECT MIN(rowid) FROM collection_tag GROUP BY collection_id, tag_id)"
+                ))
+                conn.execute(text(
+                    "DELETE FROM tag WHERE tag_id NOT IN (SELECT MIN(tag_id) FROM tag GROUP BY tag_name)"
+                ))
+
+        inspector = inspect(engine)
+        for table in base.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    with engine.begin() as conn:
+                        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info(f"数据库迁移：已添加字段 {table.name}.{column.name}")
+
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(engine)
+                    logger.info(f"数据库迁移：已建立索引 {index.name}")
+
+        # 补全旧数据的发布日期
+        table = Collection.__table__
+        with engine.begin() as conn:
+            rows = conn.execute(select(table.c.collection_id, table.c.year, table.c.month, table.c.day)
+                                .where(table.c.published.is_(None))).fetchall()
+            values = [{"id": row[0], "published": published_date(*row[1:])} for row in rows]
+            values = [value for value in values if value["published"]]
+            if values:
+                conn.execute(table.update().where(table.c.collection_id == bindparam("id"))
+                             .values(published=bindparam("published")), values)
+                logger.info(f"数据库迁移：已补全 {len(values)} 个合集的发布日期")
+
+    @staticmethod
+    def _create_fts(engine):
+        """建立合集名称的 FTS5 全文索引，由触发器与 collection 表保持同步，返回是否可用
+
+        使用 trigram 分词，中文标题无需分词即可按任意 3 个字以上的片段检索；SQLite 不支持时返回 False。
+        """
+        if "collection_fts" in inspect(engine).get_table_names():
+            return True
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE collection_fts USING fts5("
+                    "name, content='collection', content_rowid='collection_id', tokenize='trigram')"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER collection_fts_ai AFTER INSERT ON collection BEGIN "
+                    "INSERT INTO collection_fts(rowid, name) VALUES (new.collection_id, new.name); END"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER collection_fts_ad AFTER DELETE ON collection BEGIN "
+                    "INSERT INTO collection_fts(collection_fts, rowid, name) "
+                    "VALUES ('delete', old.collection_id, old.name); END"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER collection_fts_au AFTER UPDATE OF name ON collection BEGIN "
+                    "INSERT INTO collection_fts(collection_fts, rowid, name) "
+                    "VALUES ('delete', old.collection_id, old.name); "
+                    "INSERT INTO collection_fts(rowid, name) VALUES (new.collection_id, new.name); END"
+                ))
+                conn.execute(text("INSERT INTO collection_fts(collection_fts) VALUES ('rebuild')"))
+        except OperationalError as e:
+            logger.warning(f"SQLite 不支持 FTS5 trigram 分词，合集名称检索将使用 LIKE：{e!r}")
+            return False
+        logger.info("数据库迁移：已建立合集名称全文索引")
+        return True
+
+    def _load_tags(self, session):
+        """从数据库（重新）加载标签缓存"""
+        self.tag_cache = dict(session.query(Tag.tag_name, Tag.tag_id).all())
+
+    def close(self):
+        """提交剩余的写操作，关闭数据库连接"""
+        self.writer.close()
+        self.session.close()
+
+    async def wait(self, future):
+        """持久化模式下，等待写操作提交"""
+        if self.durable:
+            await asyncio.wrap_future(future)
+
+    @contextmanager
+    def _read(self):
+        """读操作结束后及时结束事务，避免读锁阻塞写库线程"""
+        try:
+            yield self.session
+        finally:
+            self.session.rollback()
+
     def reset_dl(self):
-        """重置下载记录"""
-        self.session.query(DownloadRecord).all().update({DownloadRecord.dl_status: 0})
-        self.session.commit()
+        """重置下载记录，返回 Future，结果为重置的合集数
+
+        所有图片同时标记为待下载，保留大小和哈希，下载时可从内容寻址存储中直接恢复。
+        """
+        return self.writer.submit(self._reset_dl)
+
+    @staticmethod
+    def _reset_dl(session):
+        session.query(PictureRecord) \
+            .update({PictureRecord.status: PICTURE_PENDING, PictureRecord.attempts: 0,
+                     PictureRecord.last_error: None}, synchronize_session=False)
+        return session.query(DownloadRecord) \
+            .filter(DownloadRecord.dl_status != 0) \
+            .update({DownloadRecord.dl_status: 0}, synchronize_session=False)
 
     def report(self):
-        """返回数据库中的数据统计"""
-        # 合集总数
-        total_nums = self.session.query(func.count(DownloadRecord.collection_num)).scalar()
-        # 已获取的合集元数据数
-        info_nums = self.session.query(func.count(Collection.collection_num)).scalar()
-        # 已完成下载图片的合集数
-        dl_nums = self.session.query(func.count(DownloadRecord.dl_status)).filter(
-            DownloadRecord.dl_status == 1).scalar()
-        # 合集中包含的图片总数（理论）
-        picture_nums = self.session.query(func.sum(Collection.total_num)).filter().scalar()
-
-        return total_nums, info_nums, dl_nums, picture_nums
+        """返回数据库中的数据统计，一次聚合查询完成"""
+        with self._read() as session:
+            row = session.query(
+                # 合集总数
+                func.count(DownloadRecord.collection_num),
+                # 已获取的合集元数据数
+                session.query(func.count(Collection.collection_num)).label("info_nums"),
+                # 已完成下载图片的合集数
+                func.count(case((DownloadRecord.dl_status == 1, 1))),
+                # 合集中包含的图片总数（理论）
+                session.query(func.sum(Collection.total_num)).label("picture_nums"),
+            ).one()
+
+        total_nums, info_nums, dl_nums, picture_nums = row
+        return total_nums, info_nums, dl_nums, picture_nums or 0
+
+    def get_crawled_tags(self):
+        """返回已完整采集过全部分页的标签"""
+        with self._read() as session:
+            return {record.tag for record in session.query(TagCrawl.tag).filter(TagCrawl.completed.isnot(None))}
+
+    def mark_tag_crawled(self, tag):
+        """记录该标签的全部分页已完整采集"""
+        return self.writer.submit(self._mark_tag_crawled, tag, time.time())
+
+    @staticmethod
+    def _mark_tag_crawled(session, tag, completed):
+        session.merge(TagCrawl(tag=tag, completed=completed))
+        logger.info(f"标签：{tag} 已完整采集")
 
     def get_all_collection_numbers(self):
         """返回所有记录的合集编号"""
-        return [i.collection_num for i in self.session.query(DownloadRecord.collection_num).all()]
+        with self._read() as session:
+            return [i.collection_num for i in session.query(DownloadRecord.collection_num).all()]
 
     def get_not_info_collection(self):
         """返回还未获取合集元数据的合集编号"""
         res = []
-        records = self.session.query(DownloadRecord).filter_by(status=0)
-        for record in records:
-            res.append(record.collection_num)
+        with self._read() as session:
+            records = session.query(DownloadRecord).filter(DownloadRecord.status == 0, _info_not_exhausted())
+            for record in records:
+                res.append(record.collection_num)
 
         return set(res)
 
-    def get_not_dl_collection(self):
-        """返回还未下载图片的合集信息"""
-        res = []
-        records = self.session.query(Collection.collection_num, Collection.name, Collection.total_num,
-                                     Collection.url_prefix, Collection.url_suffix) \
-            .outerjoin(DownloadRecord, Collection.collection_num == DownloadRecord.collection_num) \
-            .filter(DownloadRecord.status == 1, DownloadRecord.dl_status == 0)
+    def count_not_dl_collection(self):
+        """返回还未下载图片的合集数量"""
+        with self._read() as session:
+            return session.query(func.count(Collection.collection_id)) \
+                .join(DownloadRecord, Collection.collection_num == DownloadRecord.collection_num) \
+                .filter(DownloadRecord.status == 1, DownloadRecord.dl_status == 0) \
+                .scalar()
+
+    def iter_not_dl_collection(self, page_size=None):
+        """分页读取还未下载图片的合集，逐条返回 `PendingCollection`
 
-        for record in records:
-            picture_url_list = list()
-            for i in range(1, int(record.total_num) + 1):
-                num = "0" + str(i) if i < 10 else str(i)
-                url = record.url_prefix + num + record.url_suffix
-                picture_url_list.append(url)
-            res.append((record.collection_num, record.name, picture_url_list))
+        按合集ID从新到旧分页，每页在单独的短事务中读取，不会一次性把全部待下载合集载入内存。
+        只返回调用时已存在的合集，之后新增的合集由采集任务直接入队，避免重复下载。
+        """
+        for pending, _ in self._iter_collection(page_size, DownloadRecord.dl_status == 0):
+            yield pending
 
-        return res
+    def iter_info_collection(self, page_size=None):
+        """分页读取所有已获取元数据的合集，逐条返回 (`PendingCollection`, 图片下载状态)"""
+        return self._iter_collection(page_size)
+
+    def _iter_collection(self, page_size=None, *criterion):
+        page_size = page_size or PENDING_PAGE_SIZE
+        with self._read() as session:
+            last_id = (session.query(func.max(Collection.collection_id)).scalar() or 0) + 1
+        while True:
+            with self._read() as session:
+                records = session.query(Collection.collection_id, Collection.collection_num, Collection.name,
+                                        Collection.url_prefix, Collection.url_suffix, Collection.total_num,
+                                        DownloadRecord.dl_status) \
+                    .join(DownloadRecord, Collection.collection_num == DownloadRecord.collection_num) \
+                    .filter(DownloadRecord.status == 1, Collection.collection_id < last_id, *criterion) \
+                    .order_by(Collection.collection_id.desc()) \
+                    .limit(page_size) \
+                    .all()
+
+            for record in records:
+                yield PendingCollection(record.collection_num, record.name, record.url_prefix, record.url_suffix,
+                                        int(record.total_num)), record.dl_status
+            if len(records) < page_size:
+                return
+            last_id = records[-1].collection_id
 
     def add_collection_number(self, number: str):
         """单条添加合集编号"""
-        self.session.add(DownloadRecord(collection_num=str(number)))
-        self.session.commit()
+        return self.writer.submit(self._add_collection_number, str(number))
+
+    @staticmethod
+    def _add_collection_number(session, number):
+        session.add(DownloadRecord(collection_num=number))
         logger.info(f"添加一条合集编号：{number}")
 
     def batch_add_collection_number(self, numbers):
         """批量添加合集编号"""
-        count = 0
-        for number in numbers:
-            # 格式校验
-            if not number.isdigit():
-                continue
-
-            self.session.add(DownloadRecord(collection_num=str(number)))
-            count += 1
-            if count % 100 == 0:  # 对于sqlite，单次提交不能超过99条
-                self.session.flush()
+        # 格式校验
+        numbers = [str(number) for number in numbers if number.isdigit()]
+        return self.writer.submit(self._batch_add_collection_number, numbers)
 
-        self.session.commit()
-        logger.info(f"添加{count}条编号")
+    @staticmethod
+    def _batch_add_collection_number(session, numbers):
+        for count, number in enumerate(numbers, 1):
+            session.add(DownloadRecord(collection_num=number))
+            if count % 100 == 0:  # 对于sqlite，单次提交不能超过99条
+                session.flush()
+        logger.info(f"添加{len(numbers)}条编号")
 
     def add_collection_info(self, entry: dict):
         """添加合集元数据"""
-        tags = []
-        for tag_name in entry['tag_names']:
-            t = self._get_tag(tag_name)
-            if t.count() == 0:  # tag不存在
-                self._add_tag(tag_name)
-                tags.append(self.session.query(Tag).filter_by(tag_name=tag_name).first())
-            else:  # tag 存在
-                tags.append(t.first())
-
-        del entry['tag_names']
-        entry['tags'] = tags
-        collection = Collection(**entry)
-        self.session.add(collection)
-
-        self._update_info_status(entry["collection_num"], 1)
-        self.session.commit()
-
-    def _add_tag(self, tag: str):
-        self.session.add(Tag(tag_name=tag))
-        self.session.commit()
-
-    def _get_tag(self, tag):
-        return self.session.query(Tag).filter_by(tag_name=tag)
+        return self.writer.submit(self._add_collection_info, dict(entry))
+
+    def _add_collection_info(self, session, entry):
+        tag_names = list(dict.fromkeys(entry.pop('tag_names')))
+        self._upsert_tags(session, tag_names)
+
+        collection = Collection(**entry, published=published_date(entry["year"], entry["month"], entry["day"]))
+        session.add(collection)
+        session.flush()
+
+        if tag_names:
+            session.execute(collection_tag.insert(), [
+                {"collection_id": collection.collection_id, "tag_id": self.tag_cache[tag_name]}
+                for tag_name in tag_names
+            ])
+
+        self._update_info_status(session, entry["collection_num"], 1)
+
+    def _upsert_tags(self, session, tag_names):
+        """批量写入缓存中没有的标签，并将其ID加入缓存"""
+        missing = [tag_name for tag_name in tag_names if tag_name not in self.tag_cache]
+        if not missing:
+            return
+
+        # 标签名唯一，其他进程已写入的标签会被忽略
+        stmt = Tag.__table__.insert() \
+            .prefix_with("OR IGNORE", dialect="sqlite") \
+            .prefix_with("IGNORE", dialect="mysql")
+        session.execute(stmt, [{"tag_name": tag_name} for tag_name in missing])
+        self.tag_cache.update(session.query(Tag.tag_name, Tag.tag_id).filter(Tag.tag_name.in_(missing)).all())
 
     def get_numbers_of_not_info(self):
         """获取还未获取元数据的合集"""
@@ -134,25 +381,167 @@ class DB:
     def get_numbers_of_not_picture(self):
         """获取还未下载图片的合集"""
         collections = []
-        dl_records = self.session.query(DownloadRecord).filter_by(dl_status=0)
-        for dl_record in dl_records:
-            collections.extend(self.session.query(Collection).filter_by(collection_num=dl_record.collection_num).all())
+        with self._read() as session:
+            dl_records = session.query(DownloadRecord).filter_by(dl_status=0)
+            for dl_record in dl_records:
+                collections.extend(session.query(Collection).filter_by(collection_num=dl_record.collection_num).all())
 
         return collections
 
-    def _update_info_status(self, collection_num, status):
+    @staticmethod
+    def _update_info_status(session, collection_num, status):
         """更新合集元信息获取状态"""
-        self.session.query(DownloadRecord) \
+        session.query(DownloadRecord) \
             .filter(DownloadRecord.collection_num == collection_num) \
             .update({"status": status})
-        self.session.commit()
         logger.info(f"合集编号：{collection_num} 元数据入库完毕")
 
+    def get_picture_records(self, collection_num):
+        """返回合集的图片下载清单：{图片序号: 记录（status、attempts、size、sha256）}"""
+        with self._read() as session:
+            records = session.query(PictureRecord.picture_num, PictureRecord.status, PictureRecord.attempts,
+                                    PictureRecord.size, PictureRecord.sha256) \
+                .filter(PictureRecord.collection_num == collection_num)
+            return {record.picture_num: record for record in records}
+
+    def update_picture_record(self, collection_num, picture_num, status, size=None, attempts=0, error=None,
+                              sha256=None):
+        """记录单张图片的下载结果"""
+        record = PictureRecord(collection_num=collection_num, picture_num=picture_num, status=status, size=size,
+                               attempts=attempts, last_error=error[:200] if error else None, sha256=sha256)
+        return self.writer.submit(self._update_picture_record, record)
+
+    @staticmethod
+    def _update_picture_record(session, record):
+        session.merge(record)
+
+    def requeue_pictures(self, collection_num, problems, keep=()):
+        """将校验未通过的图片重新标记为待下载，合集同时标记为未下载
+
+        :param problems: [(图片序号, 原因)]
+        :param keep: 保留下载时记录的大小和哈希的图片序号，下载前先尝试从内容寻址存储中恢复
+        """
+        return self.writer.submit(self._requeue_pictures, collection_num, problems, set(keep))
+
+    @staticmethod
+    def _requeue_pictures(session, collection_num, problems, keep):
+        for picture_num, reason in problems:
+            record = session.get(PictureRecord, (collection_num, picture_num))
+            if record is None:
+                record = PictureRecord(collection_num=collection_num, picture_num=picture_num)
+                session.add(record)
+            record.status = PICTURE_PENDING
+            record.attempts = 0
+            record.last_error = reason[:200]
+            if picture_num not in keep:
+                record.size = None
+                record.sha256 = None
+        session.query(DownloadRecord) \
+            .filter(DownloadRecord.collection_num == collection_num) \
+            .update({"dl_status": 0})
+        logger.info(f"合集编号：{collection_num} 有 {len(problems)} 张图片需要重新下载")
+
     def update_picture_status(self, collection_num, status):
         """更新合集图片下载状态"""
-        self.session.query(DownloadRecord) \
-            .filter(DownloadRecord.collection_num == collection_num) \
-            .update({"dl_status": status})
+        return self.writer.submit(self._update_picture_status, collection_num, status)
 
-        self.session.commit()
+    @staticmethod
+    def _update_picture_status(session, collection_num, status):
+        session.query(DownloadRecord) \
+            .filter(DownloadRecord.collection_num == collection_num) \
+            .update({"dl_status": status, "lease_owner": None, "lease_expires": None})
         logger.info(f"合集编号：{collection_num} 图片下载完毕")
+
+    def claim(self, owner, limit):
+        """领取一批待处理的合集（未获取元数据或未下载），返回 (合集编号列表, PendingCollection 列表)
+
+        在写库线程中先选出空闲或租约已过期的记录，再以仍然空闲为条件写入租约，
+        多个进程同时领取时，同一条记录只会被一个进程领到。
+        """
+        return self.writer.submit(self._claim, owner, limit)
+
+    @staticmethod
+    def _claim(session, owner, limit):
+        now = time.time()
+        free = _lease_free(now)
+        pending = _pending()
+
+        candidates = [record.collection_num for record in
+                      session.query(DownloadRecord.collection_num).filter(free, pending).limit(limit)]
+        if candidates:
+            session.query(DownloadRecord) \
+                .filter(DownloadRecord.collection_num.in_(candidates), free) \
+                .update({"lease_owner": owner, "lease_expires": now + LEASE_TTL}, synchronize_session=False)
+
+        mine = DownloadRecord.lease_owner == owner
+        numbers = [record.collection_num for record in
+                   session.query(DownloadRecord.collection_num).filter(mine, DownloadRecord.status == 0)]
+        records = session.query(Collection.collection_num, Collection.name, Collection.url_prefix,
+                                Collection.url_suffix, Collection.total_num) \
+            .join(DownloadRecord, Collection.collection_num == DownloadRecord.collection_num) \
+            .filter(mine, DownloadRecord.status == 1, DownloadRecord.dl_status == 0)
+        pendings = [PendingCollection(record.collection_num, record.name, record.url_prefix, record.url_suffix,
+                                      int(record.total_num)) for record in records]
+        return numbers, pendings
+
+    def renew_leases(self, owner):
+        """续约该进程持有的全部租约"""
+        return self.writer.submit(self._renew_leases, owner)
+
+    @staticmethod
+    def _renew_leases(session, owner):
+        return session.query(DownloadRecord) \
+            .filter(DownloadRecord.lease_owner == owner) \
+            .update({"lease_expires": time.time() + LEASE_TTL}, synchronize_session=False)
+
+    def fail_info(self, collection_num):
+        """记录一次元数据获取失败：释放租约，按失败次数退避，退避期间不会被再次领取"""
+        return self.writer.submit(self._fail_info, collection_num, time.time())
+
+    @staticmethod
+    def _fail_info(session, collection_num, now):
+        record = session.get(DownloadRecord, collection_num)
+        if record is None:
+            return
+        record.attempts = (record.attempts or 0) + 1
+        record.lease_owner = None
+        record.lease_expires = now + INFO_RETRY_BACKOFF * 2 ** (record.attempts - 1)
+        if record.attempts >= INFO_MAX_ATTEMPTS:
+            logger.warning(f"合集编号：{collection_num} 元数据获取失败 {record.attempts} 次，不再重试")
+
+    def release_lease(self, collection_num):
+        """释放单个合集的租约，使其可被其他进程重新领取"""
+        return self.writer.submit(self._release_lease, collection_num)
+
+    @staticmethod
+    def _release_lease(session, collection_num):
+        session.query(DownloadRecord) \
+            .filter(DownloadRecord.collection_num == collection_num) \
+            .update({"lease_owner": None, "lease_expires": None}, synchronize_session=False)
+
+    def release_all_leases(self, owner):
+        """释放该进程持有的全部租约"""
+        return self.writer.submit(self._release_all_leases, owner)
+
+    @staticmethod
+    def _release_all_leases(session, owner):
+        return session.query(DownloadRecord) \
+            .filter(DownloadRecord.lease_owner == owner) \
+            .update({"lease_owner": None, "lease_expires": None}, synchronize_session=False)
+
+    def reap_leases(self):
+        """回收所有已过期的租约，返回回收数量"""
+        return self.writer.submit(self._reap_leases)
+
+    @staticmethod
+    def _reap_leases(session):
+        return session.query(DownloadRecord) \
+            .filter(DownloadRecord.lease_expires < time.time()) \
+            .update({"lease_owner": None, "lease_expires": None}, synchronize_session=False)
+
+    def count_pending(self):
+        """返回还未处理完毕（未获取元数据或未下载）的合集数量，不含失败次数耗尽或正在退避的合集"""
+        with self._read() as session:
+            return session.query(func.count(DownloadRecord.collection_num)) \
+                .filter(_pending(), or_(DownloadRecord.lease_owner.isnot(None), _lease_free(time.time()))) \
+                .scalar()
@@ -0,0 +1,150 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-10 21:20
+合集目录查询：按标签（交集/并集）、发布日期范围、名称关键字筛选合集，分页返回结果
+"""
+import datetime
+from typing import NamedTuple
+
+from sqlalchemy import Integer, column, func, select, text
+
+from mzitu.core.base import DB
+from mzitu.core.model import Collection, Tag, collection_tag
+from mzitu.log import get_logger
+
+logger = get_logger(__name__)
+
+# trigram 分词只能检索 3 个字符及以上的片段，更短的关键字使用 LIKE
+FTS_MIN_LENGTH = 3
+
+
+class CatalogEntry(NamedTuple):
+    """查询结果中的一个合集"""
+    collection_id: int
+    num: str
+    name: str
+    published: datetime.date
+    count: int
+
+
+class Catalog:
+    """合集目录查询
+
+    结果按合集ID从新到旧排列，使用合集ID作为游标分页（keyset），翻页的开销与页码无关。
+    例如查询 2019 年同时带有两个标签的合集：
+        catalog.iter(tags_all=["性感", "美腿"], since="2019-01-01", until="2019-12-31")
+    """
+
+    def __init__(self, db: DB):
+        self.db = db
+
+    def tag_ids(self, tag_names):
+        """将标签名转换为标签ID，不存在的标签对应 None"""
+        cache = self.db.tag_cache
+        missing = [tag_name for tag_name in tag_names if tag_name not in cache]
+        found = {}
+        if missing:
+            # 其他进程新写入的标签不在缓存中
+            with self.db._read() as session:
+                found = dict(session.query(Tag.tag_name, Tag.tag_id).filter(Tag.tag_name.in_(missing)).all())
+        return [cache.get(tag_name, found.get(tag_name)) for tag_name in tag_names]
+
+    def _criteria(self, tags_all=(), tags_any=(), since=None, until=None, keyword=None):
+        """构造查询条件，条件不可能满足时返回 None"""
+        criteria = []
+
+        # 交集：每个标签一个子查询，均走 (tag_id, collection_id) 索引
+        for tag_id in self.tag_ids(list(tags_all)):
+            if tag_id is None:
+                return None
+            criteria.append(Collection.collection_id.in_(
+                select(collection_tag.c.collection_id).where(collection_tag.c.tag_id == tag_id)))
+
+        # 并集：忽略不存在的标签
+        if tags_any:
+            tag_ids = [tag_id for tag_id in self.tag_ids(list(tags_any)) if tag_id is not None]
+            if not tag_ids:
+                return None
+            criteria.append(Collection.collection_id.in_(
+                select(collection_tag.c.collection_id).where(collection_tag.c.tag_id.in_(tag_ids))))
+
+        if since is not None:
+            criteria.append(Collection.published >= _as_date(since))
+        if until is not None:
+            criteria.append(Collection.published <= _as_date(until))
+
+        if keyword:
+            if self.db.fts and len(keyword) >= FTS_MIN_LENGTH:
+                # 整个关键字作为一个短语匹配
+                match = text("SELECT rowid FROM collection_fts WHERE collection_fts MATCH :phrase") \
+                    .bindparams(phrase='"' + keyword.replace('"', '""') + '"') \
+                    .columns(column("rowid", Integer))
+                criteria.append(Collection.collection_id.in_(match))
+            else:
+                escaped = keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                criteria.append(Collection.name.like(f"%{escaped}%", escape="\\"))
+        return criteria
+
+    def page(self, tags_all=(), tags_any=(), since=None, until=None, keyword=None, after=None, limit=100):
+        """返回一页结果和下一页的游标，没有更多结果时游标为 None
+
+        :param tags_all: 必须同时带有的标签
+        :param tags_any: 至少带有其中一个的标签
+        :param since: 发布日期下限（含），date 或 `YYYY-MM-DD` 字符串
+        :param until: 发布日期上限（含）
+        :param keyword: 合集名称中包含的关键字
+        :param after: 上一页返回的游标，从该合集之后开始
+        """
+        criteria = self._criteria(tags_all, tags_any, since, until, keyword)
+        if criteria is None:
+            return [], None
+        if after is not None:
+            criteria.append(Collection.collection_id < after)
+
+        with self.db._read() as session:
+            rows = session.query(Collection.collection_id, Collection.collection_num, Collection.name,
+                                 Collection.published, Collection.total_num) \
+                .filter(*criteria) \
+                .order_by(Collection.collection_id.desc()) \
+                .limit(limit) \
+                .all()
+
+        entries = [CatalogEntry(*row) for row in rows]
+        cursor = entries[-1].collection_id if len(entries) == limit else None
+        return entries, cursor
+
+    def iter(self, tags_all=(), tags_any=(), since=None, until=None, keyword=None, page_size=500):
+        """逐条返回所有符合条件的合集，每页在单独的短事务中读取"""
+        after = None
+        while True:
+            entries, after = self.page(tags_all, tags_any, since, until, keyword, after=after, limit=page_size)
+            yield from entries
+            if after is None:
+                return
+
+    def count(self, tags_all=(), tags_any=(), since=None, until=None, keyword=None):
+        """符合条件的合集数"""
+        criteria = self._criteria(tags_all, tags_any, since, until, keyword)
+        if criteria is None:
+            return 0
+        with self.db._read() as session:
+            return session.query(func.count(Collection.collection_id)).filter(*criteria).scalar()
+
+    def tags(self):
+        """返回所有标签及其合集数：[(标签名, 合集数)]，按合集数从多到少排列"""
+        with self.db._read() as session:
+            counts = session.query(collection_tag.c.tag_id,
+                                   func.count(collection_tag.c.collection_id).label("collection_count")) \
+                .group_by(collection_tag.c.tag_id) \
+                .subquery()
+            rows = session.query(Tag.tag_name, counts.c.collection_count) \
+                .join(counts, Tag.tag_id == counts.c.tag_id) \
+                .order_by(counts.c.collection_count.desc()) \
+                .all()
+        return [(tag_name, count) for tag_name, count in rows]
+
+
+def _as_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value)
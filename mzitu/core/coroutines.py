@@ -2,53 +2,80 @@
 """
 time: 2020-09-29 1:38 
 """
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from lxml import etree
 
-from mzitu.settings import SITE_BASE_URL
+from mzitu.metrics import metrics
+from mzitu.settings import SITE_BASE_URL, PARSE_EXECUTOR, PARSE_WORKERS
 from mzitu.utils import page_session, get_logger
 
-logger = get_logger()
+logger = get_logger(__name__)
 
+# 预编译的 XPath 表达式
+TAG_HREFS = etree.XPath("//dl[@class='tags']/dd/a/@href")
+TAG_MAX_PAGES = etree.XPath("//div[@class='nav-links']/a[last()-1]/text()")
+PIN_HREFS = etree.XPath("//ul[@id='pins']/li/a/@href")
+MAIN_TAGS = etree.XPath("//div[@class='main-tags']/a/text()")
+PAGE_TOTAL = etree.XPath("//div[@class='pagenavi']/a[last()-1]/span/text()")
+MAIN_TITLE = etree.XPath("//h2[@class='main-title']/text()")
+MAIN_IMAGE = etree.XPath("//div[@class='main-image']/p/a/img/@src")
 
-async def get_all_tag():
-    """从`专题页`获取所有的标签"""
-    url = f"{SITE_BASE_URL}/zhuanti/"
-    page = await page_session.get(url)
+_executor = None
+
+
+def _get_executor():
+    """惰性创建解析线程池/进程池"""
+    global _executor
+    if _executor is None:
+        if PARSE_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix="parser")
+        logger.debug(f"页面解析池已创建，类型：{PARSE_EXECUTOR}，工作者数：{PARSE_WORKERS or '默认'}")
+    return _executor
+
+
+def shutdown_parser():
+    """关闭页面解析池"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+async def _parse(func, *args):
+    """在解析池中执行页面解析，避免阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    with metrics.timer("parse_seconds", func=func.__name__):
+        return await loop.run_in_executor(_get_executor(), func, *args)
+
+
+def parse_all_tag(page):
     html = etree.HTML(page)
-    one_level_urls = html.xpath("//dl[@class='tags']/dd/a/@href")
-    return [url.replace("https://www.mzitu.com/tag/", "").strip("/") for url in one_level_urls]
+    return [url.replace("https://www.mzitu.com/tag/", "").strip("/") for url in TAG_HREFS(html)]
 
 
-async def get_max_pages_in_tag(tag):
-    """获取该`标签`的分页总数，进而可以构造出所有标签页地址"""
-    url = f"{SITE_BASE_URL}/tag/{tag}/"
-    page = await page_session.get(url)
+def parse_max_pages_in_tag(page):
     html = etree.HTML(page)
-    max_pages = int(html.xpath("//div[@class='nav-links']/a[last()-1]/text()")[0])
-    return max_pages
+    return int(TAG_MAX_PAGES(html)[0])
 
 
-async def extract_number_in_tag(tag_detail_url):
-    """从`标签分页`抽取合集编号"""
-    text = await page_session.get(tag_detail_url)
+def parse_number_in_tag(text):
     html = etree.HTML(text)
-    hrefs = html.xpath("//ul[@id='pins']/li/a/@href")
-    numbers = [href.strip(f"{SITE_BASE_URL}/") for href in hrefs]
-    return numbers
+    # 合集地址形如 https://www.mzitu.com/12345，取最后一段
+    return [href.rstrip("/").rsplit("/", 1)[-1] for href in PIN_HREFS(html)]
 
 
-async def extract_info_from_number(collection_num):
-    """根据合集编号，构造出合集首页地址，进而抽取元数据"""
-    url = f"{SITE_BASE_URL}/{collection_num}"
-    text = await page_session.get(url)
+def parse_info(text, collection_num):
     html = etree.HTML(text)
-    tag_names = html.xpath("//div[@class='main-tags']/a/text()")
-    total_num = html.xpath("//div[@class='pagenavi']/a[last()-1]/span/text()")[0]
-    name = html.xpath("//h2[@class='main-title']/text()")[0]
+    tag_names = [str(tag_name) for tag_name in MAIN_TAGS(html)]
+    total_num = str(PAGE_TOTAL(html)[0])
+    name = str(MAIN_TITLE(html)[0])
 
-    img_first_url = html.xpath("//div[@class='main-image']/p/a/img/@src")[0]
+    img_first_url = str(MAIN_IMAGE(html)[0])
 
     splits_1 = os.path.split(img_first_url)
     url_prefix = splits_1[0] + "/" + splits_1[1][:3]
@@ -70,4 +97,31 @@ async def extract_info_from_number(collection_num):
         "url_suffix": url_suffix,
         "tag_names": tag_names,
     }
-    return res
\ No newline at end of file
+    return res
+
+
+async def get_all_tag():
+    """从`专题页`获取所有的标签"""
+    url = f"{SITE_BASE_URL}/zhuanti/"
+    page = await page_session.get(url)
+    return await _parse(parse_all_tag, page)
+
+
+async def get_max_pages_in_tag(tag):
+    """获取该`标签`的分页总数，进而可以构造出所有标签页地址"""
+    url = f"{SITE_BASE_URL}/tag/{tag}/"
+    page = await page_session.get(url)
+    return await _parse(parse_max_pages_in_tag, page)
+
+
+async def extract_number_in_tag(tag_detail_url):
+    """从`标签分页`抽取合集编号"""
+    text = await page_session.get(tag_detail_url)
+    return await _parse(parse_number_in_tag, text)
+
+
+async def extract_info_from_number(collection_num):
+    """根据合集编号，构造出合集首页地址，进而抽取元数据"""
+    url = f"{SITE_BASE_URL}/{collection_num}"
+    text = await page_session.get(url)
+    return await _parse(parse_info, text, collection_num)
@@ -0,0 +1,71 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-10-20 22:05
+"""
+
+
+class NumberIndex:
+    """已知合集编号索引
+
+    所有采集任务共享同一个实例，新编号在入库时同步加入索引；编号以整数存储以节省内存。
+    同时记录增量采集时每个标签遇到的“全部已知”分页数，用于提前停止翻页；
+    只有曾经完整采集过全部分页的标签才会提前停止，避免首次采集中断后，较旧的分页再也采集不到。
+    """
+
+    def __init__(self, numbers=(), stop_pages=1, crawled_tags=()):
+        self._numbers = {int(number) for number in numbers if str(number).isdigit()}
+        self.stop_pages = stop_pages
+        self._known_pages = {}
+        # 已完整采集过的标签
+        self.crawled_tags = set(crawled_tags)
+        # 本次运行中各标签尚未处理的分页数，以及有分页被跳过或失败的标签
+        self._pending_pages = {}
+        self._incomplete = set()
+
+    def __contains__(self, number):
+        return str(number).isdigit() and int(number) in self._numbers
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def add_new(self, numbers):
+        """返回未见过的合集编号，并将其加入索引；格式不合法的编号会被忽略"""
+        new_numbers = []
+        for number in numbers:
+            if not number.isdigit():
+                continue
+            key = int(number)
+            if key not in self._numbers:
+                self._numbers.add(key)
+                new_numbers.append(number)
+        return new_numbers
+
+    def mark_known_page(self, tag):
+        """记录该标签出现了一页全部为已知编号的分页"""
+        self._known_pages[tag] = self._known_pages.get(tag, 0) + 1
+
+    def is_exhausted(self, tag):
+        """该标签剩余的分页是否都已采集过"""
+        return tag in self.crawled_tags and self._known_pages.get(tag, 0) >= self.stop_pages
+
+    def expect_pages(self, tag, pages):
+        """记录本次运行中该标签需要处理的分页数"""
+        self._pending_pages[tag] = int(pages)
+
+    def page_done(self, tag, complete=True):
+        """记录该标签的一个分页处理完毕，`complete` 为 False 表示该分页被跳过或获取失败
+
+        :return: 该标签是否在本次运行中首次完整采集了全部分页
+        """
+        if not complete:
+            self._incomplete.add(tag)
+        if tag not in self._pending_pages:
+            return False
+        self._pending_pages[tag] -= 1
+        if self._pending_pages[tag] > 0:
+            return False
+        del self._pending_pages[tag]
+        if tag in self._incomplete or tag in self.crawled_tags:
+            return False
+        self.crawled_tags.add(tag)
+        return True
@@ -2,24 +2,31 @@
 """
 time: 2020-09-27 22:41 
 """
-from sqlalchemy import Column, String, Integer, ForeignKey, Table
+from sqlalchemy import Column, String, Integer, ForeignKey, Table, Index, BigInteger, Float, Date
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 base = declarative_base()
 
+# 图片下载状态
+PICTURE_PENDING = 0
+PICTURE_DONE = 1
+PICTURE_FAILED = 2
+
 
 class Tag(base):
     """ 标签 """
     __tablename__ = "tag"
 
     tag_id = Column("tag_id", Integer, primary_key=True, autoincrement=True)
-    tag_name = Column("tag_name", String(50), )
+    tag_name = Column("tag_name", String(50), unique=True, index=True)
 
 
 collection_tag = Table('collection_tag', base.metadata,
-                       Column('collection_id', Integer, ForeignKey('collection.collection_id')),
-                       Column('tag_id', Integer, ForeignKey('tag.tag_id'))
+                       Column('collection_id', Integer, ForeignKey('collection.collection_id'), index=True),
+                       Column('tag_id', Integer, ForeignKey('tag.tag_id'), index=True),
+                       # 按标签筛选合集时只需扫描索引
+                       Index("ix_collection_tag_tag_collection", "tag_id", "collection_id"),
                        )
 
 
@@ -28,12 +35,13 @@ class Collection(base):
     __tablename__ = "collection"
 
     collection_id = Column("collection_id", Integer, primary_key=True, autoincrement=True)
-    collection_num = Column("collection_num", String(15), )
+    collection_num = Column("collection_num", String(15), index=True)
     name = Column("name", String(100))
     total_num = Column("image_num", Integer)
     year = Column("year", String(6))
     month = Column("month", String(6))
     day = Column("day", String(6))
+    published = Column("published", Date, index=True)  # 由 year、month、day 得到的发布日期，用于按日期查询
     url_prefix = Column("url_prefix", String(100))  # 妹子图资源地址前缀，和图片数量进行结合即可拼接出地址。
     url_suffix = Column("url_suffix", String(50))
 
@@ -47,3 +55,34 @@ class DownloadRecord(base):
     collection_num = Column("collection_num", String(15), primary_key=True)
     status = Column("status", Integer, default=0)  # 合集信息获取状态
     dl_status = Column("dl_status", Integer, default=0)  # 合集图片下载状态
+    lease_owner = Column("lease_owner", String(64))  # 多进程模式下，持有该合集的工作进程
+    lease_expires = Column("lease_expires", Float)  # 租约到期时间（时间戳）；获取失败后为可再次领取的时间
+    attempts = Column("attempts", Integer, default=0)  # 元数据获取失败次数
+
+    __table_args__ = (
+        # 待处理任务查询：status=0（待获取元数据）、status=1 且 dl_status=0（待下载）
+        Index("ix_download_record_pending", "status", "dl_status"),
+        Index("ix_download_record_dl_status", "dl_status"),
+        Index("ix_download_record_lease", "lease_owner", "lease_expires"),
+    )
+
+
+class PictureRecord(base):
+    """ 图片下载清单 """
+    __tablename__ = "picture_record"
+
+    collection_num = Column("collection_num", String(15), primary_key=True)
+    picture_num = Column("picture_num", Integer, primary_key=True)  # 图片在合集中的序号，从 1 开始
+    status = Column("status", Integer, default=PICTURE_PENDING)
+    size = Column("size", BigInteger)  # 文件字节数
+    attempts = Column("attempts", Integer, default=0)  # 累计下载尝试次数
+    last_error = Column("last_error", String(200))
+    sha256 = Column("sha256", String(64), index=True)  # 文件内容哈希
+
+
+class TagCrawl(base):
+    """ 标签分页的采集记录，标签为专题页中的英文标识 """
+    __tablename__ = "tag_crawl"
+
+    tag = Column("tag", String(50), primary_key=True)
+    completed = Column("completed", Float)  # 首次完整采集全部分页的时间（时间戳）
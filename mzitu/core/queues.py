@@ -0,0 +1,40 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-10-28 22:30
+"""
+import asyncio
+import itertools
+
+
+class PriorityQueue(asyncio.PriorityQueue):
+    """有界优先队列
+
+    出队顺序由 `key(item)` 决定，值越小越先出队，相同时按入队顺序；队列满时 `put` 会等待，使上游任务降速。
+    """
+
+    def __init__(self, maxsize=0, key=None):
+        super().__init__(maxsize)
+        self._key = key or (lambda item: 0)
+        self._seq = itertools.count()
+
+    def _put(self, item):
+        super()._put((self._key(item), next(self._seq), item))
+
+    def _get(self):
+        return super()._get()[2]
+
+
+def newest_number_first(number):
+    """合集编号越大越新，优先处理"""
+    return -int(number) if str(number).isdigit() else 0
+
+
+def newest_collection_first(pending):
+    return newest_number_first(pending.num)
+
+
+def shallow_page_first(item):
+    """标签分页越靠前内容越新，先处理所有标签的第一页，再处理第二页，以此类推"""
+    tag, url = item
+    page = url.rstrip("/").rsplit("/", 1)[-1]
+    return int(page) if page.isdigit() else 0
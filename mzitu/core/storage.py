@@ -0,0 +1,195 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-10-25 21:15
+"""
+import errno
+import hashlib
+import json
+import mmap
+import os
+import struct
+import warnings
+import zipfile
+
+from mzitu.settings import CAS_ENABLED, CAS_PATH, DL_PATH
+from mzitu.log import get_logger
+
+logger = get_logger(__name__)
+
+invalid_chars_in_path = ['*', '|', ':', '：', '?', '/', '<', '>', '"', '\\']
+
+
+def collection_dir(collection_name):
+    """返回合集的下载目录，删除合集名称中的非法字符"""
+    for char in invalid_chars_in_path:
+        if char in collection_name:
+            collection_name = collection_name.replace(char, "")
+    return os.path.join(DL_PATH, collection_name)
+
+
+# 表示文件系统不支持硬链接（或跨文件系统）的错误码，出现时关闭去重
+LINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+
+class BlobStore:
+    """内容寻址存储
+
+    每个文件按 SHA-256 只保存一份，合集目录中的图片是指向它的硬链接；
+    文件系统不支持硬链接时保留原文件，不做去重。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.linkable = True
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def adopt(self, file_path, digest):
+        """将新下载的文件纳入存储：已有相同内容时改为指向已有文件的硬链接，否则将其登记为新文件"""
+        if not self.linkable:
+            return
+        blob = self.blob_path(digest)
+        try:
+            try:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.link(file_path, blob)
+                return
+            except FileExistsError:
+                # 已有相同内容，或另一个线程同时登记了相同内容的文件
+                pass
+
+            if not os.path.samefile(blob, file_path):
+                tmp_path = file_path + ".link"
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                os.link(blob, tmp_path)
+                os.replace(tmp_path, file_path)
+        except OSError as e:
+            if e.errno in LINK_UNSUPPORTED:
+                self.linkable = False
+                logger.warning(f"文件系统不支持硬链接，关闭去重：{e!r}")
+            else:
+                logger.warning(f"{file_path} 去重失败，保留原文件：{e!r}")
+
+    def restore(self, digest, size, file_path):
+        """存储中已有内容和大小都一致的文件时，直接链接到目标路径，返回是否成功
+
+        链接前重新计算存储中文件的哈希，文件已损坏时返回 False。
+        """
+        if not self.linkable or not digest:
+            return False
+        blob = self.blob_path(digest)
+        try:
+            if os.path.getsize(blob) != size or self._digest(blob) != digest:
+                return False
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            os.link(blob, file_path)
+            return True
+        except OSError:
+            return False
+
+
+    @staticmethod
+    def _digest(file_path):
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as fd:
+            for block in iter(lambda: fd.read(1024 * 1024), b""):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+
+# 打包时跳过的临时文件：未下载完成的文件、硬链接替换时的临时文件
+TEMP_SUFFIXES = (".part", ".link")
+PACK_SUFFIX = ".zip"
+INDEX_SUFFIX = ".idx"
+# zip 本地文件头：固定 30 字节，文件名长度和扩展字段长度位于第 26、28 字节
+LOCAL_HEADER = struct.Struct("<26xHH")
+
+
+def pack_path(dir_path):
+    """合集目录对应的打包文件"""
+    return dir_path + PACK_SUFFIX
+
+
+def pack_collection(dir_path):
+    """将合集目录中的图片追加到打包文件，写入索引后删除已打包的文件，返回打包的文件数
+
+    使用不压缩的 zip 格式，任何解压工具都能打开；同名文件再次打包时追加新的副本，索引指向最后一份。
+    """
+    path = pack_path(dir_path)
+    names = sorted(name for name in os.listdir(dir_path) if not name.endswith(TEMP_SUFFIXES))
+    with zipfile.ZipFile(path, "a" if os.path.exists(path) else "w", zipfile.ZIP_STORED) as zf, \
+            warnings.catch_warnings():
+        # 重新下载的图片与已打包的同名
+        warnings.simplefilter("ignore", UserWarning)
+        for name in names:
+            zf.write(os.path.join(dir_path, name), name)
+    write_pack_index(path)
+
+    for name in names:
+        os.remove(os.path.join(dir_path, name))
+    if not os.listdir(dir_path):
+        os.rmdir(dir_path)
+    return len(names)
+
+
+def write_pack_index(path):
+    """根据 zip 的中央目录生成索引：{文件名: [数据偏移, 大小]}，读取时无需解析 zip 结构"""
+    index = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as fd:
+        for info in zf.infolist():
+            fd.seek(info.header_offset)
+            name_length, extra_length = LOCAL_HEADER.unpack(fd.read(LOCAL_HEADER.size))
+            offset = info.header_offset + LOCAL_HEADER.size + name_length + extra_length
+            index[info.filename] = [offset, info.file_size]
+
+    tmp_path = path + INDEX_SUFFIX + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fd:
+        json.dump(index, fd, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path + INDEX_SUFFIX)
+
+
+class PackReader:
+    """读取打包文件
+
+    整个文件通过 mmap 映射，`read` 返回指向映射内存的 memoryview，不复制数据；
+    关闭前需先释放所有返回的 memoryview。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + INDEX_SUFFIX, encoding="utf-8") as fd:
+            self.index = json.load(fd)
+        with open(path, "rb") as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def locate(self, name):
+        """返回图片数据在打包文件中的 (偏移, 大小)"""
+        return self.index[name]
+
+    def read(self, name):
+        offset, size = self.index[name]
+        return memoryview(self.mm)[offset:offset + size]
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+blob_store = BlobStore(CAS_PATH or os.path.join(DL_PATH, ".blobs")) if CAS_ENABLED else None
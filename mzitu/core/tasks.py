@@ -3,120 +3,309 @@
 time: 2020-09-28 22:12 
 """
 import os
-import random
+import json
+import time
 import asyncio
-from asyncio import Queue, sleep
+from asyncio import Queue
 
-from mzitu.core.base import DB
+from mzitu.core.base import DB, PendingCollection
+from mzitu.core.index import NumberIndex
 from mzitu.core.coroutines import extract_number_in_tag, get_all_tag, get_max_pages_in_tag, extract_info_from_number
-from mzitu.settings import SITE_BASE_URL, DL_PATH
-from mzitu.utils import invalid_chars_in_path, get_logger, dl_session
+from mzitu.core.model import PICTURE_DONE, PICTURE_FAILED
+from mzitu.core.storage import blob_store, collection_dir, pack_collection
+from mzitu.metrics import metrics
+from mzitu.settings import SITE_BASE_URL, DL_PATH, IMG_RETRY, IMG_RETRY_BACKOFF, IMG_MAX_ATTEMPTS, \
+    LEASE_RENEW_INTERVAL, LEASE_REAP_INTERVAL, LAST_TAG, TAG_DISCOVERY_CONCURRENCY, TAG_CACHE_FILE, TAG_CACHE_TTL, \
+    PACK_ENABLED
+from mzitu.log import get_logger, sampled
+from mzitu.utils import dl_session
 
-logger = get_logger()
+logger = sampled(get_logger(__name__))
 
 
-async def collect_tag_detail_url(tag_detail_url_queue: Queue):
-    """收集所有的tag详情页网址"""
-    logger.info(f"任务：{asyncio.current_task().get_name()} 启动")
-    tags = await get_all_tag()
-    for tag in tags:
-        try:
-            max_pages = await get_max_pages_in_tag(tag)
-        except (ConnectionError, IndexError):
-            continue
+def _read_tag_pages():
+    """读取标签缓存，缓存不存在、已过期、为空或不属于当前站点及 `LAST_TAG` 时返回 None"""
+    try:
+        with open(TAG_CACHE_FILE, encoding="utf-8") as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cache.get("time", 0) > TAG_CACHE_TTL:
+        return None
+    if cache.get("site") != SITE_BASE_URL or cache.get("last_tag") != LAST_TAG:
+        return None
+    return cache.get("tags") or None
+
+
+def _write_tag_pages(tag_pages):
+    tmp_path = TAG_CACHE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fd:
+        json.dump({"time": time.time(), "site": SITE_BASE_URL, "last_tag": LAST_TAG, "tags": tag_pages}, fd,
+                  ensure_ascii=False)
+    os.replace(tmp_path, TAG_CACHE_FILE)
+
+
+async def put_tag_detail_urls(tag_detail_url_queue: Queue, tag, max_pages, index: NumberIndex = None):
+    """根据分页总数构造出该标签下所有的分页地址并入队"""
+    if index is not None:
+        index.expect_pages(tag, max_pages)
+    for i in range(1, int(max_pages) + 1):
+        url = f"{SITE_BASE_URL}/{tag}/page/{i}"
+        await tag_detail_url_queue.put((tag, url))
+
+
+async def collect_tag_detail_url(tag_detail_url_queue: Queue, index: NumberIndex = None):
+    """收集所有的tag详情页网址
+
+    各标签的分页总数并发获取，每个标签获取完毕即将其分页地址入队；
+    全部标签都获取成功时，标签及其分页总数缓存到文件，`TAG_CACHE_TTL` 秒内再次运行时直接使用缓存。
+    标签列表获取失败时记录日志后返回，不影响已有合集的下载。
+    """
+    task_name = asyncio.current_task().get_name()
+    logger.info(f"任务：{task_name} 启动")
+    loop = asyncio.get_running_loop()
+
+    tag_pages = await loop.run_in_executor(None, _read_tag_pages)
+    if tag_pages is not None:
+        logger.info(f"使用缓存的标签列表，共 {len(tag_pages)} 个标签")
+        for tag, max_pages in tag_pages.items():
+            metrics.inc("pipeline_items_total", task=task_name)
+            await put_tag_detail_urls(tag_detail_url_queue, tag, max_pages, index)
+        return
+
+    try:
+        tags = await get_all_tag()
+    except (ConnectionError, IndexError) as e:
+        # 本次不再采集新编号，数据库中已有的待处理合集照常下载
+        logger.error(f"标签列表获取失败：{e!r}，跳过本次标签采集")
+        return
+    # 只采集到指定的标签为止
+    if LAST_TAG in tags:
+        tags = tags[:tags.index(LAST_TAG) + 1]
 
-        # 根据分页总数构造出该标签下所有的分页地址
-        for i in range(1, int(max_pages) + 1):
-            url = f"{SITE_BASE_URL}/{tag}/page/{i}"
-            await tag_detail_url_queue.put(url)
+    tag_pages = {}
+    semaphore = asyncio.Semaphore(TAG_DISCOVERY_CONCURRENCY)
+
+    async def discover(tag):
+        async with semaphore:
+            try:
+                max_pages = await get_max_pages_in_tag(tag)
+            except (ConnectionError, IndexError):
+                return
+        metrics.inc("pipeline_items_total", task=task_name)
+        tag_pages[tag] = max_pages
+        await put_tag_detail_urls(tag_detail_url_queue, tag, max_pages, index)
+
+    await asyncio.gather(*(discover(tag) for tag in tags))
+    # 只缓存完整的结果，有标签获取失败时下次运行重新获取
+    if tags and len(tag_pages) == len(tags):
+        await loop.run_in_executor(None, _write_tag_pages, {tag: tag_pages[tag] for tag in tags})
+    else:
+        logger.warning(f"{len(tags) - len(tag_pages)} 个标签的分页总数获取失败，不缓存标签列表")
 
-        # todo：最后一个标签
-        if tag == "cosplay":
-            break
 
+async def collect_number(db: DB, index: NumberIndex, tag_detail_url_queue: Queue, number_queue: Queue = None,
+                         incremental=False):
+    """从tag详情页中提取合集编号，并将未记录的编号入库、入队
+
+    增量模式下，标签分页按从新到旧排列，曾经完整采集过的标签出现全部为已知编号的分页后，跳过该标签剩余的分页。
+    某个标签的全部分页在一次运行中都处理成功后，记录为已完整采集。
+    `number_queue` 为 None 时只入库（多进程模式下由工作进程从数据库领取）。
+    """
+    task_name = asyncio.current_task().get_name()
+    logger.info(f"任务：{task_name} 启动")
+
+    async def page_done(tag, complete=True):
+        if index.page_done(tag, complete):
+            await db.wait(db.mark_tag_crawled(tag))
+        tag_detail_url_queue.task_done()
 
-async def collect_number(db: DB, tag_detail_url_queue: Queue, number_queue: Queue):
-    """从tag详情页中提取合集编号，并将未记录的编号入库、入队"""
-    logger.info(f"任务：{asyncio.current_task().get_name()} 启动")
-    db_numbers = db.get_all_collection_numbers()
     while True:
-        url = await tag_detail_url_queue.get()
+        tag, url = await tag_detail_url_queue.get()
+        metrics.inc("pipeline_items_total", task=task_name)
+        if incremental and index.is_exhausted(tag):
+            await page_done(tag, complete=False)
+            continue
+
+        try:
+            numbers = await extract_number_in_tag(url)
+        except (ConnectionError, IndexError):
+            await page_done(tag, complete=False)
+            continue
 
-        numbers = await extract_number_in_tag(url)
-        new_numbers = set(numbers) - set(db_numbers)
+        new_numbers = index.add_new(numbers)
         if not new_numbers:
-            tag_detail_url_queue.task_done()
+            index.mark_known_page(tag)
+            await page_done(tag)
             continue
 
-        for number in new_numbers:
-            await number_queue.put(number)
-        db.batch_add_collection_number(new_numbers)
+        if number_queue is not None:
+            for number in new_numbers:
+                await number_queue.put(number)
+        await db.wait(db.batch_add_collection_number(new_numbers))
 
-        tag_detail_url_queue.task_done()
+        await page_done(tag)
         logger.debug(f"新入库、入队 {len(new_numbers)} 条编号")
 
 
+async def feed_not_info(db: DB, number_queue: Queue):
+    """将数据库中遗留的未获取元数据的合集编号入队"""
+    numbers = db.get_not_info_collection()
+    logger.debug(f"》》 编号队列，共计：{len(numbers)} 条")
+    for number in numbers:
+        await number_queue.put(number)
+
+
+async def feed_pending(db: DB, info_queue: Queue):
+    """将数据库中遗留的待下载合集分页读出并入队"""
+    count = 0
+    for pending in db.iter_not_dl_collection():
+        await info_queue.put(pending)
+        count += 1
+        if count % 100 == 0:
+            # 让出事件循环，避免大量遗留任务入队时阻塞其他任务
+            await asyncio.sleep(0)
+    logger.debug(f"》》 元数据队列，共计：{count} 条")
+
+
 async def collect_info(db: DB, number_queue: Queue, info_queue: Queue):
     """收集合集信息"""
-    logger.info(f"任务：{asyncio.current_task().get_name()} 启动")
+    task_name = asyncio.current_task().get_name()
+    logger.info(f"任务：{task_name} 启动")
     while True:
         number = await number_queue.get()
-        info = await extract_info_from_number(number)
+        metrics.inc("pipeline_items_total", task=task_name)
+        try:
+            info = await extract_info_from_number(number)
+        except (ConnectionError, IndexError):
+            logger.warning(f"合集：{number} 元数据获取失败")
+            await db.wait(db.fail_info(number))
+            number_queue.task_done()
+            continue
 
-        db.add_collection_info(info)
+        await db.wait(db.add_collection_info(info))
 
-        picture_url_list = list()
-        for i in range(1, int(info['total_num']) + 1):
-            num = "0" + str(i) if i < 10 else str(i)
-            url = info['url_prefix'] + num + info['url_suffix']
-            picture_url_list.append(url)
-        await info_queue.put((number, info['name'], picture_url_list))
+        await info_queue.put(PendingCollection(number, info['name'], info['url_prefix'], info['url_suffix'],
+                                               int(info['total_num'])))
 
         number_queue.task_done()
         logger.info(f"合集：{number} 元数据已入库、入队")
 
 
-async def downloader(db: DB, info_queue: Queue):
-    """合集图片下载器"""
-    logger.info(f"任务：{asyncio.current_task().get_name()} 启动")
-    while True:
-        collection_number, collection_name, url_list = await info_queue.get()
-        logger.info(f"开始下载合集：{collection_name}，共有{len(url_list)}张图片")
-
-        # 此合集下载失败的图片数量，若大于 10，返回None 合集下载失败
-        fail_count = 0
-        for img_url in url_list:
-            await sleep(random.uniform(.5, 2.5))
+def is_settled(record):
+    """图片是否已处理完毕：下载成功，或累计尝试次数已耗尽"""
+    if record is None:
+        return False
+    return record.status == PICTURE_DONE or (record.status == PICTURE_FAILED and record.attempts >= IMG_MAX_ATTEMPTS)
 
-            file_name = img_url.split("/")[-1]
 
-            # 检查文件夹命名的格式，删除命名中的非法字符
-            for char in invalid_chars_in_path:
-                if char in collection_name:
-                    collection_name = collection_name.replace(char, "")
-            dir_path = os.path.join(DL_PATH, collection_name)
+async def download_picture(db: DB, collection_number, picture_num, img_url, dir_path, record,
+                           semaphore: asyncio.Semaphore):
+    """下载单张图片并写入下载清单，失败时按指数退避重试，返回图片是否已处理完毕"""
+    loop = asyncio.get_running_loop()
+    file_path = os.path.join(dir_path, img_url.split("/")[-1])
 
-            if not os.path.exists(dir_path):
-                try:
-                    os.mkdir(dir_path)
-                except NotADirectoryError:
-                    os.mkdir(os.path.join(DL_PATH, "unknown"))
+    # 旧版本下载的图片没有清单记录，已存在则直接补录
+    if record is None and os.path.exists(file_path):
+        await db.wait(db.update_picture_record(collection_number, picture_num, PICTURE_DONE,
+                                               size=os.path.getsize(file_path)))
+        metrics.inc("images_total", result="existing")
+        return True
 
-            file_path = os.path.join(dir_path, file_name)
+    # 内容寻址存储中已有相同哈希和大小的文件，直接链接，无需下载
+    if record is not None and blob_store is not None \
+            and await loop.run_in_executor(None, blob_store.restore, record.sha256, record.size, file_path):
+        await db.wait(db.update_picture_record(collection_number, picture_num, PICTURE_DONE, size=record.size,
+                                               attempts=record.attempts, sha256=record.sha256))
+        metrics.inc("images_total", result="linked")
+        return True
 
-            # 如果已经下载就跳过
-            if os.path.exists(file_path):
+    attempts = record.attempts if record else 0
+    error = None
+    for i in range(IMG_RETRY):
+        if i:
+            await asyncio.sleep(IMG_RETRY_BACKOFF * 2 ** (i - 1))
+        attempts += 1
+        async with semaphore:
+            try:
+                digest = await dl_session.get(img_url, file_path=file_path)
+            except ConnectionError as e:
+                error = repr(e)
                 continue
 
+        logger.debug(f"{file_path} 下载完毕")
+        size = os.path.getsize(file_path)
+        if blob_store is not None:
+            await loop.run_in_executor(None, blob_store.adopt, file_path, digest)
+        await db.wait(db.update_picture_record(collection_number, picture_num, PICTURE_DONE, size=size,
+                                               attempts=attempts, sha256=digest))
+        metrics.inc("images_total", result="downloaded")
+        return True
+
+    logger.debug(f"{file_path} 下载失败，累计尝试 {attempts} 次")
+    metrics.inc("images_total", result="failed")
+    await db.wait(db.update_picture_record(collection_number, picture_num, PICTURE_FAILED, attempts=attempts,
+                                           error=error, size=record.size if record else None,
+                                           sha256=record.sha256 if record else None))
+    return attempts >= IMG_MAX_ATTEMPTS
+
+
+async def downloader(db: DB, info_queue: Queue, semaphore: asyncio.Semaphore):
+    """合集图片下载器
+
+    合集内的图片并发下载，所有下载器共享 `semaphore` 以限制同时下载的图片总数。
+    根据图片下载清单只下载缺失或失败的图片，全部图片处理完毕后合集才标记为已下载。
+    """
+    task_name = asyncio.current_task().get_name()
+    logger.info(f"任务：{task_name} 启动")
+    while True:
+        pending = await info_queue.get()
+        metrics.inc("pipeline_items_total", task=task_name)
+        collection_number, collection_name = pending.num, pending.name
+
+        records = db.get_picture_records(collection_number)
+        todo = [(picture_num, img_url) for picture_num, img_url in enumerate(pending.picture_urls(), 1)
+                if not is_settled(records.get(picture_num))]
+        logger.info(f"开始下载合集：{collection_name}，共有{pending.count}张图片，待下载{len(todo)}张")
+
+        dir_path = collection_dir(collection_name)
+
+        if todo and not os.path.exists(dir_path):
             try:
-                await dl_session.get(img_url, file_path=file_path)
-                logger.debug(f"{file_path} 下载完毕")
+                os.mkdir(dir_path)
+            except NotADirectoryError:
+                dir_path = os.path.join(DL_PATH, "unknown")
+                os.makedirs(dir_path, exist_ok=True)
 
-            except ConnectionError:
-                fail_count += 1
+        results = await asyncio.gather(*(
+            download_picture(db, collection_number, picture_num, img_url, dir_path, records.get(picture_num),
+                             semaphore)
+            for picture_num, img_url in todo
+        ))
 
-        if fail_count < 10:
-            db.update_picture_status(collection_number, 1)
-            info_queue.task_done()
+        if all(results):
+            if PACK_ENABLED and os.path.isdir(dir_path):
+                count = await asyncio.get_running_loop().run_in_executor(None, pack_collection, dir_path)
+                logger.debug(f"合集：{collection_name} 打包 {count} 张图片")
+            await db.wait(db.update_picture_status(collection_number, 1))
         else:
-            logger.warning(f"合集：{collection_name} 由于图片失败太多导致下载失败")
+            logger.warning(f"合集：{collection_name} 有 {results.count(False)} 张图片下载失败，下次运行时重试")
+            await db.wait(db.release_lease(collection_number))
+        info_queue.task_done()
+
+
+async def renew_leases(db: DB, owner):
+    """定期续约该进程持有的租约"""
+    while True:
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+        count = await asyncio.wrap_future(db.renew_leases(owner))
+        logger.debug(f"续约 {count} 条租约")
+
+
+async def reap_leases(db: DB):
+    """定期回收过期的租约"""
+    while True:
+        count = await asyncio.wrap_future(db.reap_leases())
+        if count:
+            logger.info(f"回收 {count} 条过期租约")
+        await asyncio.sleep(LEASE_REAP_INTERVAL)
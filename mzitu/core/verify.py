@@ -0,0 +1,168 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-08 21:40
+校验已下载的图片，将缺失或损坏的图片重新标记为待下载
+"""
+import mmap
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from mzitu.core.base import DB
+from mzitu.core.model import PICTURE_DONE, PICTURE_FAILED
+from mzitu.core.storage import collection_dir, pack_path, PackReader
+from mzitu.log import get_logger
+from mzitu.settings import IMG_MAX_ATTEMPTS, VERIFY_WORKERS
+
+logger = get_logger(__name__)
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND = b"IEND\xaeB`\x82"
+MISSING = "文件缺失"
+SIZE_MISMATCH = "大小不符"
+# JPEG 结尾标记之后可能还有少量填充字节，只在文件末尾这一段内查找
+JPEG_TAIL_SIZE = 64
+
+
+def relinkable(reason):
+    """文件缺失或大小不符时，下载时记录的哈希仍然可信，可从内容寻址存储中恢复；内容本身有误时只能重新下载"""
+    return reason == MISSING or reason.startswith(SIZE_MISMATCH)
+
+
+def check_data(buf, offset, size, expected_size=None):
+    """检查 `buf`（mmap）中从 `offset` 开始、长度为 `size` 的图片数据，只读取开头和结尾的几个字节"""
+    if expected_size is not None and size != expected_size:
+        return f"{SIZE_MISMATCH}：{size}/{expected_size}"
+    if not size:
+        return "空文件"
+    end = offset + size
+    head = buf[offset:offset + len(PNG_SIGNATURE)]
+    if head[:2] == JPEG_SOI:
+        if JPEG_EOI not in buf[max(end - JPEG_TAIL_SIZE, offset):end]:
+            return "缺少 JPEG 结尾标记"
+    elif head == PNG_SIGNATURE:
+        if buf[end - len(PNG_IEND):end] != PNG_IEND:
+            return "缺少 PNG 结尾标记"
+    return None
+
+
+def check_image(file_path, expected_size=None):
+    """检查单张图片，通过时返回 None，否则返回原因
+
+    文件通过 mmap 映射，只访问开头和结尾的几个字节，不读取整个文件。
+    """
+    try:
+        with open(file_path, "rb") as fd:
+            size = os.fstat(fd.fileno()).st_size
+            if not size:
+                return check_data(b"", 0, 0, expected_size)
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return check_data(mm, 0, size, expected_size)
+    except FileNotFoundError:
+        return MISSING
+    except OSError as e:
+        return repr(e)
+
+
+def check_collection(collection_num, dir_path, pictures):
+    """在子进程中检查一个合集的图片，已打包的图片在打包文件中检查，其余的在合集目录中检查
+
+    :param pictures: [(图片序号, 文件名, 期望大小)]
+    :return: (合集编号, 检查的图片数, [(图片序号, 原因)])
+    """
+    problems = []
+    reader = None
+    if os.path.exists(pack_path(dir_path)):
+        try:
+            reader = PackReader(pack_path(dir_path))
+        except (OSError, ValueError) as e:
+            logger.warning(f"打包文件：{pack_path(dir_path)} 无法读取：{e!r}")
+
+    try:
+        for picture_num, file_name, expected_size in pictures:
+            if reader is not None and file_name in reader:
+                offset, size = reader.locate(file_name)
+                if offset + size > len(reader.mm):
+                    reason = "打包文件不完整"
+                else:
+                    reason = check_data(reader.mm, offset, size, expected_size)
+            else:
+                reason = check_image(os.path.join(dir_path, file_name), expected_size)
+            if reason:
+                problems.append((picture_num, reason))
+    finally:
+        if reader is not None:
+            reader.close()
+    return collection_num, len(pictures), problems
+
+
+def plan_collection(db: DB, pending, dl_status):
+    """根据下载清单确定需要检查的图片，返回 (待检查的图片, 已确定需要重新下载的图片)
+
+    下载成功的图片按记录的大小检查；旧版本下载、没有清单记录的图片只在合集已下载时检查结尾标记；
+    尝试次数耗尽的图片直接重新下载；其余图片尚未下载，留给下载器处理。
+    """
+    records = db.get_picture_records(pending.num)
+    pictures, problems = [], []
+    for picture_num, img_url in enumerate(pending.picture_urls(), 1):
+        record = records.get(picture_num)
+        file_name = img_url.split("/")[-1]
+        if record is None:
+            if dl_status == 1:
+                pictures.append((picture_num, file_name, None))
+        elif record.status == PICTURE_DONE:
+            pictures.append((picture_num, file_name, record.size))
+        elif record.status == PICTURE_FAILED and record.attempts >= IMG_MAX_ATTEMPTS:
+            problems.append((picture_num, f"累计尝试 {record.attempts} 次仍下载失败"))
+    return pictures, problems
+
+
+def verify(db: DB, workers=None, repair=True):
+    """校验所有已获取元数据的合集，返回统计：检查的合集数、图片数、有问题的图片数
+
+    各合集的图片分发到进程池中检查，同时在途的合集数有上限，不会一次性把全部任务载入内存。
+
+    :param repair: 是否将有问题的图片重新标记为待下载，下次采集时只下载这些图片
+    """
+    workers = workers or VERIFY_WORKERS or os.cpu_count() or 1
+    stats = Counter()
+
+    def handle(collection_num, checked, problems):
+        stats["collections"] += 1
+        stats["pictures"] += checked
+        if not problems:
+            return
+        stats["problems"] += len(problems)
+        for picture_num, reason in problems:
+            logger.warning(f"合集编号：{collection_num} 第 {picture_num} 张图片校验失败：{reason}")
+        if repair:
+            db.requeue_pictures(collection_num, problems,
+                                keep=[picture_num for picture_num, reason in problems if relinkable(reason)])
+
+    with ProcessPoolExecutor(workers) as executor:
+        # 在途任务：{Future: 已确定需要重新下载的图片}
+        running = {}
+
+        def collect(futures):
+            for future in futures:
+                collection_num, checked, problems = future.result()
+                handle(collection_num, checked, running.pop(future) + problems)
+
+        for pending, dl_status in db.iter_info_collection():
+            pictures, problems = plan_collection(db, pending, dl_status)
+            if not pictures:
+                handle(pending.num, 0, problems)
+                continue
+
+            future = executor.submit(check_collection, pending.num, collection_dir(pending.name), pictures)
+            running[future] = problems
+            if len(running) >= workers * 4:
+                collect(wait(running, return_when=FIRST_COMPLETED).done)
+
+        collect(list(running))
+
+    logger.info(f"校验完毕：合集 {stats['collections']} 个，图片 {stats['pictures']} 张，"
+                f"有问题的图片 {stats['problems']} 张")
+    return stats
@@ -0,0 +1,104 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-10-18 21:30
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from mzitu.metrics import metrics
+from mzitu.settings import DB_BATCH_SIZE, DB_BATCH_INTERVAL
+from mzitu.log import get_logger, sampled
+
+logger = sampled(get_logger(__name__))
+
+_STOP = object()
+
+
+class DBWriter(threading.Thread):
+    """后台写库线程（write-behind）
+
+    写操作以 `func(session, *args)` 的形式入队，每 `batch_size` 条或每 `interval` 秒合并为一个事务提交，
+    提交在本线程内完成，不阻塞事件循环。
+    """
+
+    def __init__(self, session_factory, batch_size=None, interval=None, on_rollback=None):
+        super().__init__(name="db-writer", daemon=True)
+        self.session_factory = session_factory
+        self.on_rollback = on_rollback
+        self.batch_size = batch_size or DB_BATCH_SIZE
+        self.interval = DB_BATCH_INTERVAL if interval is None else interval
+        self.queue = queue.Queue()
+        self._closed = False
+
+    def submit(self, func, *args) -> Future:
+        """提交一个写操作，返回的 Future 在事务提交后完成"""
+        if self._closed:
+            raise RuntimeError("DBWriter 已关闭")
+        future = Future()
+        self.queue.put((func, args, future))
+        return future
+
+    def close(self):
+        """写入队列中剩余的数据并停止线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(_STOP)
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        session = self.session_factory()
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._commit(session, batch)
+        session.close()
+        logger.debug("写库线程已停止")
+
+    def _commit(self, session, batch):
+        """在一个事务中执行一批写操作；失败时逐条重试，只让出错的写操作失败"""
+        start = time.monotonic()
+        results = []
+        try:
+            for func, args, _ in batch:
+                results.append(func(session, *args))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if self.on_rollback:
+                self.on_rollback(session)
+            if len(batch) > 1:
+                for item in batch:
+                    self._commit(session, [item])
+                return
+            logger.error(f"写库失败：{e!r}")
+            batch[0][2].set_exception(e)
+            return
+
+        elapsed = time.monotonic() - start
+        metrics.observe("db_commit_seconds", elapsed)
+        metrics.inc("db_writes_total", len(batch))
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+        logger.debug(f"提交 {len(batch)} 条写操作，耗时 {elapsed * 1000:.1f} ms")
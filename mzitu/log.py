@@ -0,0 +1,121 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-05 21:30
+日志，不依赖第三方库，便于命令行按需加载
+
+日志记录经队列交给后台线程，格式化和写入都不在事件循环中进行。
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+import logging
+import logging.handlers
+
+from mzitu.settings import DEBUG, BASE_PATH, LOG_LEVELS, LOG_CALLER_INFO, LOG_DEBUG_RATE, LOG_DEBUG_BURST
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """将日志记录原样放入队列，消息的拼接和格式化都由后台线程完成
+
+    队列只在进程内使用，无需像标准的 `QueueHandler` 那样预先格式化以便序列化。
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class Logger:
+    def __init__(self):
+        self.logger = logging.getLogger("spider")
+        # 低于此级别的日志在调用处直接返回，不会创建日志记录
+        self.logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+        self.logger.propagate = False
+
+        if not LOG_CALLER_INFO:
+            # 不再查找调用位置，行号记为 0
+            logging._srcfile = None
+
+        simple_fmt = logging.Formatter("%(name)s - %(lineno)d - %(levelname)s - %(message)s")
+        stand_fmt = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(lineno)d - %(message)s",
+                                      datefmt="%Y-%m-%d %H:%M:%S")
+
+        if DEBUG:
+            # 输出到 控制台
+            handler = logging.StreamHandler()
+            handler.setLevel(logging.DEBUG)
+            handler.setFormatter(simple_fmt)
+            handler.name = "debug_handler"
+        else:
+            # 输出到文件：每天一个日志，保留最近七天。
+            log_file = os.path.join(BASE_PATH, "app.log")
+            handler = logging.handlers.TimedRotatingFileHandler(log_file, when="d", interval=1, backupCount=7,
+                                                                encoding="utf-8")
+            handler.setLevel(logging.INFO)
+            handler.setFormatter(stand_fmt)
+            handler.name = "file_handler"
+
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(DeferredQueueHandler(log_queue))
+        self.listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+        self.listener.start()
+        # 退出时写完队列中剩余的日志
+        atexit.register(self.listener.stop)
+
+        for name, level in LOG_LEVELS.items():
+            self(name).setLevel(level)
+
+        self.logger.info(f"日志初始化完毕，名称：{self.logger.name}，是否调试：{'YES' if DEBUG else 'NO'}")
+
+    def __call__(self, name=None):
+        """返回日志器，传入模块名（`__name__`）时返回该模块的子日志器，可单独设置级别"""
+        if not name:
+            return self.logger
+        if name.startswith("mzitu."):
+            name = name[len("mzitu."):]
+        return self.logger.getChild(name)
+
+
+get_logger = Logger()
+
+
+class SampledLogger(logging.LoggerAdapter):
+    """调试日志限流
+
+    逐请求、逐图片的调试日志按令牌桶限流：每秒最多 `rate` 条，允许 `burst` 条突发，超出的直接丢弃，
+    不创建日志记录；下一条输出的日志中注明此前丢弃的条数。其他级别的日志不受影响。
+    """
+
+    def __init__(self, logger, rate=None, burst=None):
+        super().__init__(logger, {})
+        self.rate = rate or LOG_DEBUG_RATE
+        self.burst = burst or LOG_DEBUG_BURST
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def debug(self, msg, *args, **kwargs):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+            self.updated = now
+            if self.tokens < 1:
+                self.dropped += 1
+                return
+            self.tokens -= 1
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped:
+            msg = f"{msg}（此前省略 {dropped} 条调试日志）"
+        # 跳过本方法所在的栈帧，记录真正的调用位置
+        kwargs.setdefault("stacklevel", 2)
+        self.logger.debug(msg, *args, **kwargs)
+
+
+def sampled(logger, rate=None, burst=None):
+    """返回调试日志限流的日志器"""
+    return SampledLogger(logger, rate, burst)
@@ -0,0 +1,192 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-10-30 21:50
+运行指标：计数器、直方图、实时值，支持导出 JSON 快照和 Prometheus 文本格式
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 延迟类直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """按分桶估算分位数，返回所在分桶的上界"""
+        if not self.count:
+            return None
+        target = q * self.count
+        for bound, total in self.cumulative():
+            if total >= target:
+                return bound
+        return None
+
+
+class MetricsRegistry:
+    """指标注册表
+
+    计数器和直方图可在任意线程中更新；实时值（如队列长度）以函数形式注册，导出时读取。
+    """
+
+    def __init__(self, prefix="mzitu"):
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._last = (time.time(), {})
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    def gauge(self, name, func, **labels):
+        """注册实时值"""
+        self._gauges[_key(name, labels)] = func
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """统计代码块的耗时（秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        """返回当前指标快照，计数器附带距上次快照的每秒速率"""
+        now = time.time()
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (h.count, h.sum, list(h.cumulative()), h.quantile(.5), h.quantile(.95),
+                                h.quantile(.99)) for key, h in self._histograms.items()}
+        last_time, last_counters = self._last
+        elapsed = max(now - last_time, 1e-9)
+        self._last = (now, counters)
+
+        return {
+            "time": now,
+            "counters": [{"name": name, "labels": dict(labels), "value": value,
+                          "rate": (value - last_counters.get((name, labels), 0)) / elapsed}
+                         for (name, labels), value in sorted(counters.items())],
+            "histograms": [{"name": name, "labels": dict(labels), "count": count, "sum": total,
+                            "p50": p50, "p95": p95, "p99": p99,
+                            "buckets": {str(bound): n for bound, n in buckets}}
+                           for (name, labels), (count, total, buckets, p50, p95, p99) in sorted(histograms.items())],
+            "gauges": [{"name": name, "labels": dict(labels), "value": func()}
+                       for (name, labels), func in sorted(self._gauges.items(), key=lambda item: item[0])],
+        }
+
+    def prometheus(self) -> str:
+        """返回 Prometheus 文本格式的指标"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(h.cumulative()), h.sum, h.count) for key, h in self._histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            full_name = f"{self.prefix}_{name}"
+            if full_name not in typed:
+                lines.append(f"# TYPE {full_name} counter")
+                typed.add(full_name)
+            lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+        for (name, labels), buckets, total, count in histograms:
+            full_name = f"{self.prefix}_{name}"
+            if full_name not in typed:
+                lines.append(f"# TYPE {full_name} histogram")
+                typed.add(full_name)
+            for bound, n in buckets:
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f"{full_name}_bucket{_format_labels(labels, le=le)} {n}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {count}")
+
+        for (name, labels), func in sorted(self._gauges.items(), key=lambda item: item[0]):
+            full_name = f"{self.prefix}_{name}"
+            if full_name not in typed:
+                lines.append(f"# TYPE {full_name} gauge")
+                typed.add(full_name)
+            lines.append(f"{full_name}{_format_labels(labels)} {func()}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """将快照写入 JSON 文件"""
+        snapshot = self.snapshot()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fd:
+            json.dump(snapshot, fd, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+
+metrics = MetricsRegistry()
+
+
+async def dump_snapshots(path, interval):
+    """定期将指标快照写入文件"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(None, metrics.dump, path)
+
+
+async def serve_prometheus(host, port):
+    """启动本地 HTTP 服务，在 /metrics 提供 Prometheus 文本格式的指标，返回需在退出时清理的 runner"""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=metrics.prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
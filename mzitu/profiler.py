@@ -0,0 +1,131 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-01 20:30
+事件循环阻塞分析：持续测量事件循环延迟，阻塞期间采样事件循环线程的调用栈，按类别（db/parse/fs/other）和任务名汇总
+"""
+import asyncio
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+
+from mzitu.metrics import metrics
+
+# 按文件路径判断类别，从最内层的调用栈帧开始匹配
+CATEGORY_FILES = (
+    ("db", re.compile(r"sqlalchemy|sqlite3|mzitu[\\/]core[\\/](base|writer)\.py")),
+    ("parse", re.compile(r"lxml|mzitu[\\/]core[\\/]coroutines\.py")),
+    ("fs", re.compile(r"genericpath\.py|shutil\.py|gzip\.py|[\\/]os\.py|mzitu[\\/](cache|core[\\/]storage)\.py")),
+)
+# C 实现的文件操作没有 Python 栈帧，按调用处的源码判断
+FS_CALL = re.compile(r"\bopen\(|\.(write|read|flush|close)\(|\bos\.(stat|mkdir|makedirs|remove|replace|rename|link|"
+                     r"listdir|scandir|walk)\b|os\.path\.")
+
+
+def categorize(stack):
+    """根据调用栈判断阻塞类别"""
+    for frame in reversed(stack):
+        for category, pattern in CATEGORY_FILES:
+            if pattern.search(frame.filename):
+                return category
+        if frame.name.startswith("parse_"):
+            return "parse"
+        if frame.line and FS_CALL.search(frame.line):
+            return "fs"
+    return "other"
+
+
+class StallProfiler:
+    """事件循环阻塞分析器
+
+    事件循环中的心跳协程每隔 `interval` 秒记录一次，实际间隔超出部分即为事件循环延迟；
+    后台线程发现心跳超过 `threshold` 秒未更新时，采样事件循环线程当前的调用栈，将 `interval` 秒计入对应类别和任务。
+    """
+
+    def __init__(self, interval=0.01, threshold=0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.stall_count = 0
+        self.stall_time = 0.0
+        self.max_lag = 0.0
+        self.samples = defaultdict(float)  # (类别, 任务名) -> 阻塞秒数
+        self.stacks = Counter()  # 折叠后的调用栈 -> 采样次数
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._beat = time.monotonic()
+        self._loop = None
+        self._loop_thread_id = None
+        self._heartbeat_task = None
+        self._thread = None
+
+    def start(self):
+        """在运行中的事件循环内启动"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat(), name="stall-profiler")
+        self._thread = threading.Thread(target=self._watch, name="stall-profiler", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+        if self._thread is not None:
+            self._thread.join()
+
+    async def _heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._beat = now = time.monotonic()
+            lag = max(now - start - self.interval, 0.0)
+            metrics.observe("loop_lag_seconds", lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stall_count += 1
+                self.stall_time += lag
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            if time.monotonic() - self._beat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+
+            task = asyncio.current_task(self._loop)
+            task_name = task.get_name() if task is not None else "<loop>"
+            category = categorize(stack)
+            collapsed = ";".join([task_name] + [f"{f.name} ({f.filename}:{f.lineno})" for f in stack])
+            with self._lock:
+                self.samples[(category, task_name)] += self.interval
+                self.stacks[collapsed] += 1
+            metrics.inc("loop_stall_seconds_total", self.interval, category=category, task=task_name)
+
+    def report(self):
+        """返回文本报告"""
+        lines = [f"事件循环阻塞 {self.stall_count} 次，共 {self.stall_time:.2f} 秒，最长 {self.max_lag:.3f} 秒"]
+        with self._lock:
+            by_category = defaultdict(float)
+            for (category, _), seconds in self.samples.items():
+                by_category[category] += seconds
+            lines.append("阻塞期间的采样时间（按类别 / 任务）：")
+            for category, seconds in sorted(by_category.items(), key=lambda item: -item[1]):
+                lines.append(f"  {category}: {seconds:.2f} 秒")
+            for (category, task_name), seconds in sorted(self.samples.items(), key=lambda item: -item[1]):
+                lines.append(f"    {category} / {task_name}: {seconds:.2f} 秒")
+        return "\n".join(lines)
+
+    def write_collapsed(self, path):
+        """写入折叠格式的调用栈（可直接用 flamegraph.pl 等工具生成火焰图）"""
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+        with open(path, "w", encoding="utf-8") as fd:
+            for collapsed, count in stacks:
+                fd.write(f"{collapsed} {count}\n")
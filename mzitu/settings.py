@@ -2,6 +2,7 @@
 """
 time: 2020-09-28 22:19 
 """
+import ast
 import os
 
 DEBUG = True
@@ -9,14 +10,140 @@ DEBUG = True
 # 项目根路径
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 
+# 数据库地址
+DB_ENGINE = "sqlite:///mm.db"
+
 REQUEST_RETRY = 3
-RETRY_INTERVAL = 20
 
 # 任务并发设置
-DL_CONCURRENCY = 3
+DL_CONCURRENCY = 3  # 同时处理的合集数
 PAGE_CONCURRENCY = 1
+IMG_CONCURRENCY = 8  # 所有合集共享的图片下载并发上限
+
+# 任务队列容量：队列满时上游任务等待，避免大量任务堆积在内存中
+TAG_URL_QUEUE_SIZE = 1000
+NUMBER_QUEUE_SIZE = 500
+INFO_QUEUE_SIZE = 100
+
+# 标签发现：并发获取各标签的分页总数，结果缓存到文件
+TAG_DISCOVERY_CONCURRENCY = 5
+TAG_CACHE_FILE = os.path.join(BASE_PATH, "tags.json")  # 记录所属的 SITE_BASE_URL 和 LAST_TAG，不一致时不使用
+TAG_CACHE_TTL = 3600 * 24  # 缓存有效期（秒）
+LAST_TAG = "cosplay"  # 专题页中只采集到此标签为止，None 表示采集全部标签
+
+# 增量采集：标签分页从新到旧排列，出现若干页全部为已知编号的分页后停止翻页该标签
+# 只对曾经完整采集过全部分页的标签生效（记录在 tag_crawl 表中）
+INCREMENTAL_CRAWL = True
+INCREMENTAL_STOP_PAGES = 1
+
+# 页面解析池：thread（线程池）或 process（进程池，可利用多核）
+PARSE_EXECUTOR = "thread"
+PARSE_WORKERS = None  # 工作者数，None 表示使用默认值
 
 # 下载路径
 DL_PATH = "D:/new_mm"
+DL_CHUNK_SIZE = 64 * 1024  # 单次读取的响应块大小
+DL_BUFFER_SIZE = 1024 * 1024  # 缓冲达到此大小后写入磁盘
+
+# 内容寻址存储：图片按 SHA-256 只保存一份，合集目录中使用硬链接（需与 DL_PATH 位于同一文件系统）
+CAS_ENABLED = False
+CAS_PATH = None  # None 表示 DL_PATH/.blobs
+
+# 打包存储：合集下载完成后，图片追加到一个不压缩的 zip 文件（DL_PATH/合集名.zip）并生成索引，删除原目录
+PACK_ENABLED = False
+
+# 单张图片的重试设置
+IMG_RETRY = 3  # 每次运行中的最多尝试次数
+IMG_RETRY_BACKOFF = 5  # 重试等待（秒），按次数指数增长
+IMG_MAX_ATTEMPTS = 9  # 累计尝试次数达到此值后不再重试，视为已处理
 
 SITE_BASE_URL = "https://www.mzitu.com"
+
+# HTTP 连接池设置
+HTTP_LIMIT = 30  # 单个 Session 的最大连接数
+HTTP_LIMIT_PER_HOST = 10  # 单个主机的最大连接数
+DNS_CACHE_TTL = 600  # DNS 缓存时间（秒）
+KEEPALIVE_TIMEOUT = 60  # 空闲连接保活时间（秒）
+
+# 请求限速设置（单主机令牌桶，单位：次/秒）
+RATE_INITIAL = 1.0  # 初始速率
+RATE_MIN = 0.1  # 最低速率
+RATE_MAX = 10.0  # 最高速率
+RATE_BURST = 3  # 令牌桶容量
+RATE_INCREASE = 0.05  # 每次成功请求后速率的加性增量
+RATE_DECREASE = 0.5  # 触发反爬（429）或超时后速率的乘性衰减系数
+
+# 数据库写入设置：写操作在后台线程中按批提交
+DB_BATCH_SIZE = 200  # 每批最多合并的写操作数
+DB_BATCH_INTERVAL = 0.5  # 每批最长等待时间（秒）
+DB_DURABLE = False  # 为 True 时，任务需等待写操作提交后才继续
+PENDING_PAGE_SIZE = 500  # 启动时分页读取待下载合集，每页条数
+
+# SQLite 连接参数（每个连接建立时执行 PRAGMA）
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # 与 WAL 配合，崩溃时最多丢失最近的事务；需要更强持久性时改为 FULL
+    "cache_size": -64000,  # 负数表示 KB
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 5000,  # 毫秒
+}
+
+# 网页缓存：按 URL 正则设置缓存时间（秒），过期后发送条件请求，未匹配的网页不缓存
+PAGE_CACHE_ENABLED = True
+PAGE_CACHE_PATH = os.path.join(BASE_PATH, "page_cache")
+PAGE_CACHE_TTLS = [
+    (r"/zhuanti/$", 3600 * 24),  # 专题页（标签列表）
+    (r"/tag/[^/]+/$", 3600 * 6),  # 标签首页（分页总数）
+    (r"/page/\d+$", 0),  # 标签分页，每次都发送条件请求
+    (r"/\d+$", 3600 * 24 * 30),  # 合集首页，内容基本不变
+]
+PAGE_CACHE_OFFLINE = False  # 离线重放：只从缓存读取网页，不访问网络
+
+# 多进程/多机模式：多个工作进程共享同一个数据库，通过租约领取任务
+WORKER_ID = None  # 工作进程标识，None 表示使用“主机名-进程号”
+LEASE_BATCH = 20  # 每次领取的合集数
+LEASE_TTL = 600  # 租约有效期（秒），到期未续约的任务可被其他进程领取
+LEASE_RENEW_INTERVAL = 120  # 续约间隔（秒）
+LEASE_POLL_INTERVAL = 30  # 没有可领取的任务时，等待多久再次领取（秒）
+WORKER_IDLE_ROUNDS = 10  # 连续多少次领取不到任务后退出
+LEASE_REAP_INTERVAL = 60  # 协调进程回收过期租约的间隔（秒）
+INFO_MAX_ATTEMPTS = 5  # 合集元数据最多获取几次，失败次数耗尽后不再领取
+INFO_RETRY_BACKOFF = 60  # 元数据获取失败后，等待多久才能再次领取（秒），每失败一次翻倍
+
+# 运行指标：定期写入 JSON 快照，可选地在本地端口提供 Prometheus 文本格式（/metrics）
+METRICS_ENABLED = False
+METRICS_FILE = os.path.join(BASE_PATH, "metrics.json")
+METRICS_INTERVAL = 10  # 快照间隔（秒）
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None  # 例如 9108，None 表示不启动 HTTP 服务
+
+# 事件循环阻塞分析：阻塞期间采样调用栈，退出时输出按类别（db/parse/fs/other）和任务汇总的报告
+PROFILE_ENABLED = False
+PROFILE_INTERVAL = 0.01  # 心跳与采样间隔（秒）
+PROFILE_THRESHOLD = 0.1  # 事件循环延迟超过此值视为阻塞（秒）
+PROFILE_COLLAPSED_FILE = None  # 折叠格式调用栈的输出文件，例如 os.path.join(BASE_PATH, "stalls.folded")
+
+
+# 校验已下载的图片：多进程检查文件大小和 JPEG/PNG 结尾标记
+VERIFY_WORKERS = None  # 进程数，None 表示 CPU 核数
+
+
+# 日志：格式化和写入在后台线程中进行
+LOG_LEVELS = {}  # 按模块设置日志级别，例如 {"utils": "INFO", "core.writer": "WARNING"}
+LOG_CALLER_INFO = True  # 是否记录调用位置（行号），关闭可减少每条日志的开销
+LOG_DEBUG_RATE = 20  # 逐请求、逐图片的调试日志每秒最多输出的条数，超出的丢弃并计数
+LOG_DEBUG_BURST = 100
+
+
+def _parse_override(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+# 使用环境变量覆盖以上设置，变量名为 `MZITU_` 加设置名，值按 Python 字面量解析，无法解析时作为字符串
+# 例如：MZITU_DL_PATH=/data/mm MZITU_DL_CONCURRENCY=5
+for _name, _value in os.environ.items():
+    if _name.startswith("MZITU_") and _name[6:].isupper() and _name[6:] in globals():
+        globals()[_name[6:]] = _parse_override(_value)
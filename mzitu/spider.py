@@ -3,14 +3,26 @@
 time: 2020-09-29 22:48 
 """
 import os
+import socket
 import asyncio
 
-from mzitu.core.base import DB
-from mzitu.settings import DL_PATH, DEBUG, PAGE_CONCURRENCY, DL_CONCURRENCY
-from mzitu.core.tasks import collect_tag_detail_url, collect_info, collect_number, downloader
-from mzitu.utils import get_logger
+from sqlalchemy.exc import OperationalError
 
-logger = get_logger()
+from mzitu.core.base import DB
+from mzitu.settings import DL_PATH, DEBUG, PAGE_CONCURRENCY, DL_CONCURRENCY, IMG_CONCURRENCY, INCREMENTAL_CRAWL, \
+    INCREMENTAL_STOP_PAGES, WORKER_ID, LEASE_BATCH, LEASE_POLL_INTERVAL, WORKER_IDLE_ROUNDS, LEASE_REAP_INTERVAL, \
+    TAG_URL_QUEUE_SIZE, NUMBER_QUEUE_SIZE, INFO_QUEUE_SIZE, METRICS_ENABLED, METRICS_FILE, METRICS_INTERVAL, \
+    METRICS_HOST, METRICS_PORT, PROFILE_ENABLED, PROFILE_INTERVAL, PROFILE_THRESHOLD, PROFILE_COLLAPSED_FILE
+from mzitu.core.coroutines import shutdown_parser
+from mzitu.core.index import NumberIndex
+from mzitu.core.queues import PriorityQueue, newest_number_first, newest_collection_first, shallow_page_first
+from mzitu.core.tasks import collect_tag_detail_url, collect_info, collect_number, downloader, feed_pending, \
+    feed_not_info, renew_leases, reap_leases
+from mzitu.metrics import metrics, dump_snapshots, serve_prometheus
+from mzitu.profiler import StallProfiler
+from mzitu.utils import get_logger, page_session, dl_session
+
+logger = get_logger(__name__)
 
 
 class Spider:
@@ -18,58 +30,124 @@ class Spider:
         self.db = DB()
         self.page_currency = PAGE_CONCURRENCY
         self.dl_currency = DL_CONCURRENCY
+        self.img_currency = IMG_CONCURRENCY
+        self.worker_id = WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+    def start(self, mode="single"):
+        """启动爬虫
 
-    def start(self):
+        :param mode: single：单进程完成全部流程；
+                     worker：工作进程，从数据库分批领取任务，获取元数据并下载图片，可在多个进程/机器上同时运行；
+                     coordinator：协调进程，从网站采集合集编号入库，并回收过期的租约
+        """
         if not os.path.exists(DL_PATH):
             os.makedirs(DL_PATH, exist_ok=True)
 
-        asyncio.run(self.run(), debug=DEBUG)
-
-    async def run(self):
-        tag_detail_url_queue = asyncio.Queue()
-        number_queue = asyncio.Queue()
-        info_queue = asyncio.Queue()
-
-        # 初始化队列，从数据库读取数据
-        for number in self.db.get_not_info_collection():
-            number_queue.put_nowait(number)
-
-        for info in self.db.get_not_dl_collection():
-            info_queue.put_nowait(info)
+        asyncio.run(self.run(mode), debug=DEBUG)
+
+    async def run(self, mode="single"):
+        runners = {"single": self._run, "worker": self._run_worker, "coordinator": self._run_coordinator}
+        if mode not in runners:
+            raise ValueError(f"不支持的运行模式：{mode}，可选：{'、'.join(runners)}")
+
+        exporters, metrics_runner = [], None
+        if METRICS_ENABLED:
+            exporters.append(asyncio.create_task(dump_snapshots(METRICS_FILE, METRICS_INTERVAL), name="metrics"))
+            if METRICS_PORT:
+                metrics_runner = await serve_prometheus(METRICS_HOST, METRICS_PORT)
+                logger.info(f"运行指标：http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+        profiler = None
+        if PROFILE_ENABLED:
+            profiler = StallProfiler(PROFILE_INTERVAL, PROFILE_THRESHOLD)
+            profiler.start()
+
+        try:
+            await runners[mode]()
+        finally:
+            if profiler is not None:
+                await profiler.stop()
+                logger.info(profiler.report())
+                if PROFILE_COLLAPSED_FILE:
+                    profiler.write_collapsed(PROFILE_COLLAPSED_FILE)
+            for t in exporters:
+                t.cancel()
+            await asyncio.gather(*exporters, return_exceptions=True)
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            if METRICS_ENABLED:
+                metrics.dump(METRICS_FILE)
+
+            # 关闭长连接池
+            await page_session.close()
+            await dl_session.close()
+            shutdown_parser()
+            # 写入剩余的数据
+            self.db.close()
+
+    def _make_index(self):
+        """所有采集任务共享的已知编号索引
+
+        增量采集只对曾经完整采集过全部分页的标签提前停止翻页，首次采集中断后，下次运行仍会继续采集较旧的分页。
+        """
+        return NumberIndex(self.db.get_all_collection_numbers(), stop_pages=INCREMENTAL_STOP_PAGES,
+                           crawled_tags=self.db.get_crawled_tags())
+
+    @staticmethod
+    def _make_queues():
+        """创建有界优先队列：标签分页优先处理靠前的分页，合集优先处理较新的"""
+        tag_detail_url_queue = PriorityQueue(TAG_URL_QUEUE_SIZE, key=shallow_page_first)
+        number_queue = PriorityQueue(NUMBER_QUEUE_SIZE, key=newest_number_first)
+        info_queue = PriorityQueue(INFO_QUEUE_SIZE, key=newest_collection_first)
+
+        metrics.gauge("queue_depth", tag_detail_url_queue.qsize, queue="tag_detail_url")
+        metrics.gauge("queue_depth", number_queue.qsize, queue="number")
+        metrics.gauge("queue_depth", info_queue.qsize, queue="info")
+        return tag_detail_url_queue, number_queue, info_queue
+
+    async def _run(self):
+        tag_detail_url_queue, number_queue, info_queue = self._make_queues()
 
         logger.debug(f"数据库遗留任务：")
-        logger.debug(f"》》 编号队列，共计：{number_queue.qsize()} 条")
-        logger.debug(f"》》 元数据队列，共计：{info_queue.qsize()} 条")
+        logger.debug(f"》》 待下载合集，共计：{self.db.count_not_dl_collection()} 条")
 
         tasks = []
 
-        # 如果当前任务较少就阻塞式地从网站更新数据，否则就放到异步执行收集标签详情页的任务
-        all_collection_numbers = self.db.get_all_collection_numbers()
-        if len(all_collection_numbers) < 1000 and info_queue.qsize() < 10:
-            logger.info("正在从网站更新数据...")
-            await collect_tag_detail_url(tag_detail_url_queue)
-            logger.info("从网站更新数据完毕！")
-        else:
-            for _ in range(self.page_currency):
-                task = asyncio.create_task(collect_tag_detail_url(tag_detail_url_queue), name="tag-detail")
-                tasks.append(task)
+        # 从数据库读取遗留任务，逐条入队，队列满时等待
+        feeders = [
+            asyncio.create_task(feed_not_info(self.db, number_queue), name="feed-not-info"),
+            asyncio.create_task(feed_pending(self.db, info_queue), name="feed-pending"),
+        ]
+        tasks.extend(feeders)
+
+        index = self._make_index()
+
+        tag_detail = asyncio.create_task(collect_tag_detail_url(tag_detail_url_queue, index), name="tag-detail")
+        tasks.append(tag_detail)
 
         for i in range(self.page_currency):
-            task = asyncio.create_task(collect_number(self.db, tag_detail_url_queue, number_queue), name=f"number-{i}")
+            task = asyncio.create_task(
+                collect_number(self.db, index, tag_detail_url_queue, number_queue, incremental=INCREMENTAL_CRAWL),
+                name=f"number-{i}")
             tasks.append(task)
 
         for j in range(self.page_currency):
             task = asyncio.create_task(collect_info(self.db, number_queue, info_queue), name=f"info-{j}")
             tasks.append(task)
 
+        img_semaphore = asyncio.Semaphore(self.img_currency)
         for k in range(self.dl_currency):
-            task = asyncio.create_task(downloader(self.db, info_queue), name=f"dl-{k}")
+            task = asyncio.create_task(downloader(self.db, info_queue, img_semaphore), name=f"dl-{k}")
             tasks.append(task)
 
         logger.info(f"任务列表：{[t.get_name() for t in asyncio.all_tasks()]}")
 
+        # 先等待各队列的生产者结束，再等待队列清空
+        await tag_detail
         await tag_detail_url_queue.join()
+        await feeders[0]
         await number_queue.join()
+        await feeders[1]
         await info_queue.join()
         logger.info("任务完成！")
 
@@ -78,10 +156,82 @@ class Spider:
 
         await asyncio.gather(*tasks, return_exceptions=True)
 
+    async def _run_worker(self):
+        """工作进程：从数据库分批领取任务，处理完一批再领取下一批"""
+        _, number_queue, info_queue = self._make_queues()
+
+        tasks = [asyncio.create_task(renew_leases(self.db, self.worker_id), name="lease-renew")]
+
+        for j in range(self.page_currency):
+            task = asyncio.create_task(collect_info(self.db, number_queue, info_queue), name=f"info-{j}")
+            tasks.append(task)
+
+        img_semaphore = asyncio.Semaphore(self.img_currency)
+        for k in range(self.dl_currency):
+            task = asyncio.create_task(downloader(self.db, info_queue, img_semaphore), name=f"dl-{k}")
+            tasks.append(task)
+
+        logger.info(f"工作进程：{self.worker_id} 启动")
+        idle = 0
+        try:
+            while idle < WORKER_IDLE_ROUNDS:
+                try:
+                    numbers, pendings = await asyncio.wrap_future(self.db.claim(self.worker_id, LEASE_BATCH))
+                except OperationalError as e:
+                    # SQLite 多进程同时写入时可能暂时无法加锁，稍后重试
+                    logger.warning(f"领取任务失败：{e!r}")
+                    numbers, pendings = [], []
+
+                if not numbers and not pendings:
+                    idle += 1
+                    await asyncio.sleep(LEASE_POLL_INTERVAL)
+                    continue
+
+                idle = 0
+                logger.info(f"领取 {len(numbers)} 个待获取元数据、{len(pendings)} 个待下载的合集")
+                for number in numbers:
+                    await number_queue.put(number)
+                for pending in pendings:
+                    await info_queue.put(pending)
+
+                await number_queue.join()
+                await info_queue.join()
+            logger.info("没有可领取的任务，工作进程退出")
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.wrap_future(self.db.release_all_leases(self.worker_id))
+
+    async def _run_coordinator(self):
+        """协调进程：从网站采集合集编号入库，等待工作进程处理完毕，期间定期回收过期租约"""
+        tag_detail_url_queue, _, _ = self._make_queues()
+        index = self._make_index()
+
+        tasks = [asyncio.create_task(reap_leases(self.db), name="lease-reap")]
+        for i in range(self.page_currency):
+            task = asyncio.create_task(
+                collect_number(self.db, index, tag_detail_url_queue, incremental=INCREMENTAL_CRAWL),
+                name=f"number-{i}")
+            tasks.append(task)
+
+        try:
+            await asyncio.create_task(collect_tag_detail_url(tag_detail_url_queue, index), name="tag-detail")
+            await tag_detail_url_queue.join()
+            logger.info("合集编号采集完毕，等待工作进程处理")
+
+            while self.db.count_pending():
+                await asyncio.sleep(LEASE_REAP_INTERVAL)
+            logger.info("任务完成！")
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
     def reset_dl(self):
         """重置下载记录"""
-        self.db.reset_dl()
-        logger.info("已重置下载记录")
+        count = self.db.reset_dl().result()
+        logger.info(f"已重置下载记录：{count} 个合集")
 
     def report(self):
         total_nums, info_nums, dl_nums, picture_nums = self.db.report()
@@ -3,16 +3,26 @@
 time: 2020-09-27 23:51 
 """
 import asyncio
+import hashlib
 import os
 import random
-import logging
-import logging.handlers
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 
 import aiohttp
 
-from mzitu.settings import DEBUG, BASE_PATH, REQUEST_RETRY, RETRY_INTERVAL
+from mzitu.cache import PageCache
+from mzitu.log import get_logger, sampled
+from mzitu.metrics import metrics
+from mzitu.settings import REQUEST_RETRY, HTTP_LIMIT, HTTP_LIMIT_PER_HOST, DNS_CACHE_TTL, \
+    KEEPALIVE_TIMEOUT, DL_CHUNK_SIZE, DL_BUFFER_SIZE, RATE_INITIAL, RATE_MIN, RATE_MAX, RATE_BURST, RATE_INCREASE, \
+    RATE_DECREASE, PAGE_CACHE_ENABLED, PAGE_CACHE_PATH, PAGE_CACHE_TTLS, PAGE_CACHE_OFFLINE
 
-invalid_chars_in_path = ['*', '|', ':', '：', '?', '/', '<', '>', '"', '\\']
+logger = sampled(get_logger(__name__))
+
+# 未下载完成的临时文件后缀
+PART_SUFFIX = ".part"
 
 user_agents = [
     "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/76.0.3809.87 Safari/537.36",
@@ -40,92 +50,268 @@ def page_header() -> dict:
     return header
 
 
-class Logger:
-    def __init__(self):
-        self.logger = logging.getLogger("spider")
-        self.logger.setLevel(logging.DEBUG)
-
-        simple_fmt = logging.Formatter("%(pathname)s - %(lineno)d - %(levelname)s - %(message)s")
-        stand_fmt = logging.Formatter("%(asctime)s - %(filename)s - %(levelname)s - %(lineno)d - %(message)s",
-                                      datefmt="%Y-%m-%d %H:%M:%S")
-
-        if DEBUG:
-            # 输出到 控制台
-            debug_handler = logging.StreamHandler()
-            debug_handler.setLevel(logging.DEBUG)
-            debug_handler.setFormatter(simple_fmt)
-            debug_handler.name = "debug_handler"
-            self.logger.addHandler(debug_handler)
-        else:
-            # 输出到文件：每天一个日志，保留最近七天。
-            log_file = os.path.join(BASE_PATH, "app.log")
-            file_handler = logging.handlers.TimedRotatingFileHandler(log_file, when="d", interval=1, backupCount=7,
-                                                                     encoding="utf-8")
-            file_handler.setLevel(logging.INFO)
-            file_handler.setFormatter(stand_fmt)
-            file_handler.name = "file_handler"
-            self.logger.addHandler(file_handler)
+def content_total(resp, offset=0):
+    """根据 `Content-Range` 或 `Content-Length` 计算文件的完整长度，未知时返回 None"""
+    content_range = resp.headers.get("Content-Range", "")
+    if "/" in content_range:
+        total = content_range.rsplit("/", 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    if resp.content_length is not None:
+        return offset + resp.content_length
+    return None
+
+
+def write_chunk(fd, hasher, data):
+    """写入数据块并更新哈希"""
+    fd.write(data)
+    hasher.update(data)
+
+
+def hash_file(hasher, file_path):
+    """将已有文件的内容计入哈希（断点续传时使用）"""
+    with open(file_path, "rb") as fd:
+        for block in iter(lambda: fd.read(DL_BUFFER_SIZE), b""):
+            hasher.update(block)
+
+
+def parse_retry_after(value):
+    """解析 `Retry-After` 响应头，返回需要等待的秒数，无法解析时返回 None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError, IndexError):
+        return None
+
 
-        self.logger.info(f"日志初始化完毕，名称：{self.logger.name}，是否调试：{'YES' if DEBUG else 'NO'}")
+class HostLimiter:
+    """单主机自适应令牌桶
 
-    def __call__(self, *args, **kwargs):
-        return self.logger
+    请求正常时速率加性增长，触发反爬（429）或超时时速率乘性衰减，并遵守 `Retry-After`。
+    """
 
+    def __init__(self, host, rate=None, burst=None):
+        self.host = host
+        self.rate = rate or RATE_INITIAL
+        self.burst = burst or RATE_BURST
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
 
-get_logger = Logger()
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """获取一个令牌，令牌不足时等待"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        """请求成功，提高速率"""
+        self.rate = min(RATE_MAX, self.rate + RATE_INCREASE)
+
+    def on_throttle(self, retry_after=None):
+        """触发反爬或超时，降低速率，清空令牌"""
+        self.rate = max(RATE_MIN, self.rate * RATE_DECREASE)
+        self.tokens = 0.0
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        logger.debug(f"主机：{self.host} 限速降至 {self.rate:.2f} 次/秒，等待：{retry_after or 0} 秒")
+
+
+class RateLimiter:
+    """按主机分配令牌桶，主站与图片服务器各自独立限速"""
+
+    def __init__(self):
+        self._limiters = {}
+
+    def get(self, url) -> HostLimiter:
+        host = urlsplit(url).hostname or ""
+        if host not in self._limiters:
+            self._limiters[host] = HostLimiter(host)
+        return self._limiters[host]
+
+
+rate_limiter = RateLimiter()
 
 
 class HttpSession:
-    def __init__(self, header_gen=None):
-        self.log = get_logger()
+    """长连接的 HTTP 请求 Session
+
+    每个实例持有一个连接池，请求之间复用 TCP/TLS 连接和 DNS 缓存，需在事件循环结束前调用 `close`。
+    指定 `cache` 时，网页请求经过 `PageCache` 缓存。
+    """
+
+    def __init__(self, header_gen=None, limit=None, limit_per_host=None, cache: PageCache = None, name=None):
+        self.log = logger
         self.header_gen = header_gen
+        self.name = name or header_gen.__name__
+        self.cache = cache
+        self.limit = limit or HTTP_LIMIT
+        self.limit_per_host = limit_per_host or HTTP_LIMIT_PER_HOST
+        self._session = None
         self.log.info(f"HTTP请求Session初始化完毕，请求头生成函数：{header_gen.__name__}")
 
+    def _get_session(self) -> aiohttp.ClientSession:
+        """惰性创建连接池，保证 ClientSession 在运行中的事件循环内创建"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             use_dns_cache=True, ttl_dns_cache=DNS_CACHE_TTL,
+                                             keepalive_timeout=KEEPALIVE_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total=60, connect=30)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self.log.debug(f"连接池已创建，最大连接数：{self.limit}，单主机最大连接数：{self.limit_per_host}")
+        return self._session
+
+    async def close(self):
+        """关闭连接池"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            self.log.debug("连接池已关闭")
+        self._session = None
+
     async def get(self, url, file_path=None):
+        """请求网页并返回文本；指定 `file_path` 时流式下载到文件，支持断点续传，返回文件的 SHA-256"""
         self.log.debug(f"请求地址：{url}")
-        await asyncio.sleep(random.uniform(.5, 1.5))
-        resp = None
-        timeout = aiohttp.ClientTimeout(total=60, connect=30)
-        connector = aiohttp.TCPConnector(limit=5)
-        session = aiohttp.ClientSession(connector=connector, headers=self.header_gen(), timeout=timeout)
+        entry = None
+        if self.cache is not None and not file_path:
+            entry = await self.cache.load(url)
+            if entry and (self.cache.offline or self.cache.is_fresh(url, entry)):
+                metrics.inc("http_cache_hits_total", session=self.name, result="fresh")
+                return entry["body"]
+            if self.cache.offline:
+                self.log.warning(f"离线模式下缓存未命中：{url}")
+                raise ConnectionError
+
+        session = self._get_session()
+        limiter = rate_limiter.get(url)
 
         for i in range(REQUEST_RETRY):
+            if i:
+                metrics.inc("http_retries_total", session=self.name)
+            await limiter.acquire()
+            start = time.perf_counter()
+            headers = self.header_gen()
+            if entry:
+                headers.update(self.cache.validators(entry))
+            offset = 0
+            if file_path:
+                offset = await self._part_size(file_path)
+                if offset:
+                    headers["Range"] = f"bytes={offset}-"
+
             try:
-                resp = await session.get(url)
-                if resp.status == 429:
-                    self.log.warning(f"请求{url}触发网站反爬机制，睡眠，重试-{i + 1}")
-                    await session.close()
-                    await asyncio.sleep(RETRY_INTERVAL)
-                    continue
-                if resp.status != 200:
-                    self.log.warning(f"请求 {url} 失败：{resp.status}")
-                    raise ConnectionError
+                async with session.get(url, headers=headers) as resp:
+                    metrics.inc("http_requests_total", session=self.name, status=resp.status)
+                    if resp.status == 429:
+                        metrics.inc("http_throttled_total", session=self.name)
+                        self.log.warning(f"请求{url}触发网站反爬机制，降速，重试-{i + 1}")
+                        limiter.on_throttle(parse_retry_after(resp.headers.get("Retry-After")))
+                        continue
+                    if resp.status == 416 and offset:
+                        self.log.warning(f"{file_path} 断点续传位置无效，重新下载")
+                        os.remove(file_path + PART_SUFFIX)
+                        continue
+                    if resp.status == 304 and entry:
+                        await self.cache.touch(url, entry)
+                        metrics.inc("http_cache_hits_total", session=self.name, result="not_modified")
+                        metrics.observe("http_fetch_seconds", time.perf_counter() - start, session=self.name)
+                        limiter.on_success()
+                        return entry["body"]
+                    if resp.status not in (200, 206):
+                        self.log.warning(f"请求 {url} 失败：{resp.status}")
+                        raise ConnectionError
 
-                if file_path:
-                    with open(file_path, 'wb') as fd:
-                        while True:
-                            chunk = await resp.content.read(1024)
-                            if not chunk:
-                                break
-                            fd.write(chunk)
+                    if file_path:
+                        digest = await self._save(resp, file_path, offset)
+                        metrics.observe("http_fetch_seconds", time.perf_counter() - start, session=self.name)
+                        limiter.on_success()
+                        return digest
 
-                text = await resp.text()
-                return text
+                    body = await resp.read()
+                    metrics.inc("http_bytes_total", len(body), session=self.name)
+                    metrics.observe("http_fetch_seconds", time.perf_counter() - start, session=self.name)
+                    text = await resp.text()
+                    if self.cache is not None:
+                        await self.cache.store(url, text, resp.headers)
+                    limiter.on_success()
+                    return text
 
             except asyncio.TimeoutError:
+                metrics.inc("http_timeouts_total", session=self.name)
                 self.log.error("timeout-1")
-                session = aiohttp.ClientSession(connector=connector, headers=self.header_gen(), timeout=timeout)
+                limiter.on_throttle()
                 continue
-            except asyncio.CancelledError:
-                self.log.error("timeout-2")
+            except aiohttp.ClientError as e:
+                self.log.error(f"请求 {url} 中断：{e!r}，重试-{i + 1}")
                 continue
-            finally:
-                if resp:
-                    resp.close()
-                await session.close()
         else:
             raise ConnectionError
 
+    @staticmethod
+    async def _part_size(file_path):
+        """返回已下载的临时文件大小，不存在时返回 0"""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, os.path.getsize, file_path + PART_SUFFIX)
+        except FileNotFoundError:
+            return 0
+
+    async def _save(self, resp, file_path, offset):
+        """流式写入临时文件，长度校验通过后原子地重命名为目标文件，返回文件的 SHA-256
+
+        文件读写和哈希计算均在线程池中执行，不阻塞事件循环；下载中断时保留临时文件，下次请求从断点处续传。
+        """
+        loop = asyncio.get_running_loop()
+        part_path = file_path + PART_SUFFIX
+
+        if resp.status != 206:
+            # 服务器未按 Range 返回，从头下载
+            offset = 0
+        expected = content_total(resp, offset)
+
+        hasher = hashlib.sha256()
+        if offset:
+            await loop.run_in_executor(None, hash_file, hasher, part_path)
+
+        fd = await loop.run_in_executor(None, open, part_path, "ab" if offset else "wb")
+        try:
+            buffer = bytearray()
+            async for chunk in resp.content.iter_chunked(DL_CHUNK_SIZE):
+                metrics.inc("http_bytes_total", len(chunk), session=self.name)
+                buffer.extend(chunk)
+                if len(buffer) >= DL_BUFFER_SIZE:
+                    await loop.run_in_executor(None, write_chunk, fd, hasher, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await loop.run_in_executor(None, write_chunk, fd, hasher, bytes(buffer))
+        finally:
+            await loop.run_in_executor(None, fd.close)
+
+        size = await loop.run_in_executor(None, os.path.getsize, part_path)
+        if expected is not None and size != expected:
+            raise aiohttp.ClientPayloadError(f"{file_path} 长度校验失败：{size}/{expected}")
+
+        await loop.run_in_executor(None, os.replace, part_path, file_path)
+        return hasher.hexdigest()
+
 
-page_session = HttpSession(header_gen=page_header)
-dl_session = HttpSession(header_gen=dl_header)
+page_cache = PageCache(PAGE_CACHE_PATH, PAGE_CACHE_TTLS, offline=PAGE_CACHE_OFFLINE) if PAGE_CACHE_ENABLED else None
+page_session = HttpSession(header_gen=page_header, cache=page_cache, name="page")
+dl_session = HttpSession(header_gen=dl_header, name="dl")
@@ -0,0 +1,92 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-12 21:30
+多进程模式的租约：领取、续约、释放、回收，以及元数据获取失败后的退避和放弃
+"""
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from mzitu.core.base import DB
+from mzitu.core.model import DownloadRecord
+from mzitu.settings import INFO_MAX_ATTEMPTS
+
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = DB(f"sqlite:///{os.path.join(self.tmp_dir.name, 'lease.db')}")
+        self.db.batch_add_collection_number([str(number) for number in range(100, 110)]).result()
+
+    def tearDown(self):
+        self.db.close()
+        self.db.session.bind.dispose()
+        self.tmp_dir.cleanup()
+
+    def claim(self, owner, limit=5):
+        numbers, pendings = self.db.claim(owner, limit).result()
+        self.assertEqual(pendings, [])
+        return set(numbers)
+
+    def expire(self, numbers):
+        """将租约改为已过期"""
+        def run(session):
+            session.query(DownloadRecord) \
+                .filter(DownloadRecord.collection_num.in_(numbers)) \
+                .update({"lease_expires": time.time() - 1}, synchronize_session=False)
+        self.db.writer.submit(run).result()
+
+    def test_two_owners_claim_disjoint_batches(self):
+        first = self.claim("a")
+        second = self.claim("b")
+        self.assertEqual(len(first), 5)
+        self.assertEqual(len(second), 5)
+        self.assertFalse(first & second)
+        # 再次领取只返回自己持有的，不会抢到对方的
+        self.assertEqual(self.claim("a"), first)
+        self.assertEqual(self.db.count_pending(), 10)
+
+    def test_renew_release_and_reap(self):
+        first = self.claim("a")
+        second = self.claim("b")
+        self.assertEqual(self.db.renew_leases("a").result(), 5)
+
+        # 过期的租约可被回收，回收后可被其他进程领取
+        self.expire(second)
+        self.assertEqual(self.db.reap_leases().result(), 5)
+        self.assertEqual(self.claim("a", limit=10), first | second)
+
+        # 释放后可被其他进程领取
+        self.assertEqual(self.db.release_all_leases("a").result(), 10)
+        self.assertEqual(self.claim("b", limit=10), first | second)
+
+    def test_failing_row_backs_off_then_is_given_up(self):
+        self.claim("a", limit=10)
+        self.db.release_all_leases("a").result()
+        number = "100"
+
+        # 失败后进入退避期：不会被立即领回，也不计入待处理数
+        self.db.fail_info(number).result()
+        self.assertNotIn(number, self.claim("b", limit=10))
+        self.assertEqual(self.db.count_pending(), 9)
+
+        # 退避期结束后可被再次领取
+        self.db.release_all_leases("b").result()
+        self.expire([number])
+        self.assertIn(number, self.claim("a", limit=10))
+
+        # 失败次数耗尽后不再领取，也不计入待处理数，工作进程和协调进程都能结束
+        with mock.patch("mzitu.core.base.INFO_RETRY_BACKOFF", 0):
+            for _ in range(INFO_MAX_ATTEMPTS - 1):
+                self.db.fail_info(number).result()
+        self.db.release_all_leases("a").result()
+        self.expire([number])
+        self.assertNotIn(number, self.claim("b", limit=10))
+        self.assertEqual(self.db.count_pending(), 9)
+        self.assertNotIn(number, self.db.get_not_info_collection())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding:utf-8  -*-
+"""
+time: 2020-11-12 22:10
+内容寻址存储：相同内容的文件同时登记时的去重
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+
+from mzitu.core.storage import BlobStore
+
+
+class BlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, data):
+        file_path = os.path.join(self.root, name)
+        with open(file_path, "wb") as fd:
+            fd.write(data)
+        return file_path
+
+    def test_concurrent_adopt_of_identical_files(self):
+        for trial in range(50):
+            store = BlobStore(os.path.join(self.root, f"blobs-{trial}"))
+            data = f"image-{trial}".encode() * 100
+            digest = hashlib.sha256(data).hexdigest()
+            paths = [self.write(f"{trial}-{i}.jpg", data) for i in range(2)]
+
+            barrier = threading.Barrier(len(paths))
+
+            def adopt(file_path):
+                barrier.wait()
+                store.adopt(file_path, digest)
+
+            threads = [threading.Thread(target=adopt, args=(file_path,)) for file_path in paths]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertTrue(store.linkable)
+            for file_path in paths:
+                self.assertTrue(os.path.samefile(store.blob_path(digest), file_path))
+
+    def test_restore_links_matching_blob(self):
+        store = BlobStore(os.path.join(self.root, "blobs"))
+        data = b"\xff\xd8image\xff\xd9"
+        digest = hashlib.sha256(data).hexdigest()
+        store.adopt(self.write("a.jpg", data), digest)
+
+        target = os.path.join(self.root, "b.jpg")
+        self.assertFalse(store.restore(digest, len(data) + 1, target))
+        self.assertTrue(store.restore(digest, len(data), target))
+        self.assertTrue(os.path.samefile(store.blob_path(digest), target))
+
+        # 存储中的文件被改写（与已下载文件共用 inode）后不再恢复
+        os.remove(target)
+        self.write("a.jpg", b"\x00" * len(data))
+        self.assertFalse(store.restore(digest, len(data), target))
+        self.assertFalse(os.path.exists(target))
+
+
+if __name__ == '__main__':
+    unittest.main()